@@ -0,0 +1,216 @@
+"""Offline microbenchmarks for Dooberhut Bot's hot paths.
+
+Runs without a Discord connection or network: channels/guilds are tiny fakes, yt-dlp is
+replaced by a stub extractor (optionally with artificial latency) and Spotify expansion
+by a stub returning N queries. Results are printed as one JSON document so runs can be
+diffed or compared in CI.
+
+    python bench/bench_hotpaths.py                     # 10 .. 100k guilds
+    python bench/bench_hotpaths.py --sizes 10,1000 --out before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = tempfile.mkdtemp(prefix="dooberhut-bench-")
+
+# must be set before bot.py is imported: it opens SMOKE_DB and reads its knobs at import
+os.environ.update({
+    "SMOKE_DB": os.path.join(TMP, "smoke.db"),
+    "SMOKE_SEND_RATE": "1000000000",  # measure our code, not the Discord rate limit
+    "METRICS_PORT": "0",
+    "LOOP_STALL_MS": "0",
+    "TRACK_CACHE_PATH": "",
+})
+os.environ.pop("TRACK_CACHE_DB", None)
+sys.path.insert(0, str(ROOT))
+
+import bot  # noqa: E402
+
+TIMEZONES = ["America/Chicago", "America/New_York", "Europe/Berlin", "Asia/Tokyo", "UTC"]
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+
+
+class FakeGuild:
+    def __init__(self, gid: int):
+        self.id = gid
+        self.voice_client = None
+
+
+def timeit(fn, repeat: int) -> float:
+    """Mean seconds per call of `fn` over `repeat` calls."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def bench_micro() -> dict:
+    now = time.time()
+    times = ["04:20", "16:20", "21:00"]
+    return {
+        "parse_timestrings_us": timeit(lambda: bot.parse_timestrings("04:20, 4:20pm, 21:00, 9:05am"), 20000) * 1e6,
+        "now_in_tz_us": timeit(lambda: bot.now_in_tz("America/Chicago"), 20000) * 1e6,
+        "next_daily_fire_us": timeit(lambda: bot.next_daily_fire(times, "America/Chicago", now), 20000) * 1e6,
+        "normalize_query_us": timeit(lambda: bot.normalize_query("  Never Gonna  GIVE you up "), 50000) * 1e6,
+    }
+
+
+def populate(n: int) -> tuple[float, int]:
+    """Fill smoke_cfg with `n` synthetic guilds; returns (seconds, bytes allocated)."""
+    rnd = random.Random(n)
+    bot.smoke_cfg.clear()
+    tracemalloc.start()
+    started = time.perf_counter()
+    for gid in range(1, n + 1):
+        cfg = bot.get_smoke_cfg(gid << 22)
+        cfg.channel_id = 1
+        cfg.tz = rnd.choice(TIMEZONES)
+        cfg.times = sorted({f"{rnd.randrange(24):02d}:{rnd.randrange(0, 60, 5):02d}" for _ in range(2)})
+    elapsed = time.perf_counter() - started
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, size
+
+
+async def bench_scale(n: int) -> dict:
+    build_s, mem = populate(n)
+
+    started = time.perf_counter()
+    for gid in bot.smoke_cfg:
+        bot.smoke_sched.reschedule(gid)
+    schedule_s = time.perf_counter() - started
+
+    # every guild due at once: the worst case for a shared reminder time
+    due = time.time()
+    target = bot.reminder_dispatch.delivered + n
+    bot.reminder_dispatch.start()
+    started = time.perf_counter()
+    for gid in bot.smoke_cfg:
+        bot.reminder_dispatch.submit(gid, due)
+    while bot.reminder_dispatch.delivered < target:
+        await asyncio.sleep(0.005)
+    tick_s = time.perf_counter() - started
+
+    bot.smoke_store._dirty.update(bot.smoke_cfg)
+    started = time.perf_counter()
+    await bot.smoke_store.flush()
+    save_s = time.perf_counter() - started
+
+    return {
+        "guilds": n,
+        "build_s": build_s,
+        "config_bytes": mem,
+        "config_bytes_per_guild": mem / n,
+        "schedule_all_s": schedule_s,
+        "tick_all_due_s": tick_s,
+        "tick_per_guild_us": tick_s / n * 1e6,
+        "save_all_s": save_s,
+    }
+
+
+async def bench_enqueue(tracks: int, resolve_latency: float) -> dict:
+    def fake_extract(query: str):
+        if resolve_latency:
+            time.sleep(resolve_latency)
+        vid = f"{abs(hash(query)) % 10**11:011d}"
+        return {"id": vid, "title": query, "url": f"https://example.invalid/{vid}?expire={int(time.time()) + 21600}",
+                "webpage_url": f"https://www.youtube.com/watch?v={vid}", "duration": 200, "acodec": "opus"}
+
+    async def fake_spotify(url: str):
+        return [f"artist {i} - song {i}" for i in range(tracks)]
+
+    bot._ydl_extract = fake_extract
+    bot.parse_spotify = fake_spotify
+    guild = FakeGuild(4242)
+    gp = bot.get_player(guild)
+    gp.play_task = asyncio.get_running_loop().create_future()  # keep player_loop from draining the queue
+    gp.queue.clear()
+
+    started = time.perf_counter()
+    added = await bot.enqueue_from_input(guild, "https://open.spotify.com/playlist/bench", "bench")
+    cold_s = time.perf_counter() - started
+    gp.queue.clear()
+    started = time.perf_counter()
+    await bot.enqueue_from_input(guild, "https://open.spotify.com/playlist/bench", "bench")
+    warm_s = time.perf_counter() - started
+
+    q = gp.queue
+    page_s = timeit(lambda: q.slice(len(q) // 2, len(q) // 2 + bot.QUEUE_PAGE_SIZE), 20000)
+    move_s = timeit(lambda: q.move(len(q) - 1, 0), 2000)
+    pop_s = timeit(lambda: q.put_nowait(q.get_nowait()), 20000)
+    gp.play_task.cancel()
+    return {
+        "tracks": added,
+        "resolve_latency_s": resolve_latency,
+        "cold_tracks_per_s": added / cold_s,
+        "cached_tracks_per_s": added / warm_s,
+        "queue_page_us": page_s * 1e6,
+        "queue_move_us": move_s * 1e6,
+        "queue_pop_push_us": pop_s * 1e6,
+    }
+
+
+async def run(args) -> dict:
+    bot.SMOKE_SAVE_DELAY = 3600  # flushes are timed explicitly; don't let the debounce fire mid-run
+    channel = FakeChannel()
+    bot.bot.get_channel = lambda cid: channel
+    bot.bot.get_guild = lambda gid: None
+    results = {"micro": bench_micro(), "scale": []}
+    for n in args.sizes:
+        results["scale"].append(await bench_scale(n))
+        print(f"  {n} guilds done", file=sys.stderr)
+    results["enqueue"] = await bench_enqueue(args.tracks, args.resolve_latency)
+    return results
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000,100000",
+                        type=lambda s: [int(x) for x in s.split(",") if x])
+    parser.add_argument("--tracks", type=int, default=500, help="playlist size for the enqueue benchmark")
+    parser.add_argument("--resolve-latency", type=float, default=0.0, help="seconds each stub lookup sleeps")
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    doc = {
+        "meta": {"git": git_rev(), "python": platform.python_version(), "platform": platform.platform(),
+                 "cpus": os.cpu_count(), "timestamp": int(time.time())},
+        **results,
+    }
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
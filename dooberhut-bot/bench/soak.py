@@ -0,0 +1,391 @@
+"""End-to-end soak simulator: hundreds of fake guilds driving the real command handlers.
+
+No Discord connection is made. Interactions, guilds, text channels and voice clients are
+fakes; the voice "sink" pulls 20 ms frames from each audio source in its own thread, the
+way discord.py's player does. Stream URLs point at a local aiohttp server that serves
+generated WAV files, and yt-dlp is replaced by a stub extractor with configurable latency.
+With ffmpeg on PATH the real FFmpeg sources are used; without it a plain HTTP PCM reader
+stands in (the CPU figure then excludes FFmpeg).
+
+    python bench/soak.py --guilds 200 --duration 600 --out soak.json
+
+Reports event-loop lag, CPU per voice stream, inter-track gaps, reminder lateness and
+per-command latency as JSON.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import wave
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+TMP = tempfile.mkdtemp(prefix="dooberhut-soak-")
+
+os.environ.update({
+    "SMOKE_DB": os.path.join(TMP, "smoke.db"),
+    "METRICS_PORT": "0",
+    "TRACK_CACHE_PATH": "",
+})
+os.environ.pop("TRACK_CACHE_DB", None)
+sys.path.insert(0, str(ROOT))
+
+import discord  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+import bot  # noqa: E402
+
+FRAME = 0.02  # seconds of audio per voice packet
+PCM_FRAME_BYTES = 3840  # 20 ms of 48 kHz 16-bit stereo
+stream_seconds = 0.0  # audio actually "sent" by all sinks
+tracks_started = 0
+
+
+# --- fake Discord objects -----------------------------------------------------------
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeResponse:
+    def __init__(self):
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+
+
+class FakeFollowup:
+    async def send(self, content=None, **kwargs):
+        return FakeMessage()
+
+
+class FakeTextChannel:
+    def __init__(self, cid: int):
+        self.id = cid
+        self.mention = f"<#{cid}>"
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage()
+
+
+class FakeVoiceChannel:
+    def __init__(self, cid: int):
+        self.id = cid
+        self.name = f"voice-{cid}"
+        self.members = [type("Listener", (), {"bot": False})()]  # keeps the empty-channel timer off
+
+
+class FakeVoiceClient:
+    """Voice sink: reads the source every 20 ms on a thread, like discord.py's AudioPlayer."""
+
+    def __init__(self, channel: FakeVoiceChannel):
+        self.channel = channel
+        self._thread = None
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+        self._finished.set()
+
+    def is_connected(self) -> bool:
+        return True
+
+    def is_playing(self) -> bool:
+        # not thread liveness: `after` runs on the sink thread and may start the next track
+        return not self._finished.is_set()
+
+    def is_paused(self) -> bool:
+        return False
+
+    def play(self, source, *, after=None):
+        global tracks_started
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        tracks_started += 1
+        self._stop = threading.Event()
+        self._finished = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(source, after, self._stop, self._finished), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop: threading.Event, finished: threading.Event):
+        global stream_seconds
+        error = None
+        try:
+            next_at = time.monotonic()
+            while not stop.is_set():
+                if not source.read():
+                    break
+                stream_seconds += FRAME
+                next_at += FRAME
+                stop.wait(max(0.0, next_at - time.monotonic()))
+        except Exception as e:
+            error = e
+        finally:
+            finished.set()  # before `after`, like AudioPlayer._end
+            source.cleanup()
+            if after:
+                after(error)
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout: float = 5.0):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    async def disconnect(self, *, force=False):
+        self.stop()
+
+
+class FakeGuild:
+    def __init__(self, gid: int):
+        self.id = gid
+        self.name = f"guild-{gid}"
+        self.voice_client = None
+        self.text = FakeTextChannel(gid + 1)
+        self.voice = FakeVoiceChannel(gid + 2)
+
+    def get_channel(self, cid: int):
+        return self.text if cid == self.text.id else None
+
+
+class FakeUser:
+    def __init__(self, name: str):
+        self.display_name = name
+        self.voice = None
+
+
+class FakeInteraction:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.text
+        self.user = FakeUser(f"user-{guild.id}")
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
+
+
+# --- stand-in media ------------------------------------------------------------------
+def make_wav(seconds: float, freq: float) -> bytes:
+    frames = int(48000 * seconds)
+    one = [int(8000 * math.sin(2 * math.pi * freq * i / 48000)) for i in range(48000 // int(freq) * 4)]
+    pcm = struct.pack(f"<{len(one) * 2}h", *(s for v in one for s in (v, v)))
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(48000)
+        w.writeframes((pcm * (frames // len(one) + 1))[: frames * 4])
+    return buf.getvalue()
+
+
+class HttpPcmSource(discord.AudioSource):
+    """Used when ffmpeg isn't installed: streams the WAV's PCM straight from the server."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._resp = None
+
+    def read(self) -> bytes:
+        if self._resp is None:
+            self._resp = urllib.request.urlopen(self.url, timeout=10)
+            self._resp.read(44)  # WAV header
+        data = self._resp.read(PCM_FRAME_BYTES)
+        return data if len(data) == PCM_FRAME_BYTES else b""
+
+    def cleanup(self):
+        if self._resp is not None:
+            self._resp.close()
+
+
+async def start_audio_server(track_seconds: float) -> tuple[web.AppRunner, int]:
+    wav = make_wav(track_seconds, 440.0)
+
+    async def audio(request: web.Request) -> web.Response:
+        return web.Response(body=wav, content_type="audio/wav")
+
+    app = web.Application()
+    app.router.add_get("/audio/{vid}.wav", audio)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, site._server.sockets[0].getsockname()[1]
+
+
+def install_stubs(port: int, args):
+    def fake_extract(query: str):
+        time.sleep(min(random.expovariate(1 / args.resolve_latency), args.resolve_latency * 5)
+                   if args.resolve_latency else 0)
+        vid = f"{abs(hash(query)) % 10**11:011d}"
+        return {"id": vid, "title": query, "duration": args.track_seconds, "acodec": "pcm_s16le",
+                "url": f"http://127.0.0.1:{port}/audio/{vid}.wav?expire={int(time.time()) + 21600}",
+                "webpage_url": f"https://www.youtube.com/watch?v={vid}"}
+
+    async def fake_spotify(url: str):
+        return [f"song {random.randrange(args.catalog)}" for _ in range(random.randint(5, args.playlist_max))]
+
+    bot._ydl_extract = fake_extract
+    bot.parse_spotify = fake_spotify
+    if not shutil.which("ffmpeg"):
+        async def pcm_source(url, acodec=None, start=0.0):
+            return HttpPcmSource(url)
+        bot.make_audio_source = pcm_source
+
+
+# --- driver ---------------------------------------------------------------------------
+class CommandStats:
+    def __init__(self):
+        self.latency: dict[str, bot.LatencyStats] = {}
+        self.errors: dict[str, int] = {}
+
+    async def run(self, name: str, coro):
+        started = time.monotonic()
+        try:
+            await coro
+        except Exception as e:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            print(f"/{name} raised:", repr(e), file=sys.stderr)
+        finally:
+            self.latency.setdefault(name, bot.LatencyStats(window=4096)).observe(time.monotonic() - started)
+
+
+async def drive_guild(guild: FakeGuild, stats: CommandStats, args, deadline: float):
+    gp = bot.get_player(guild)
+    gp.voice = FakeVoiceClient(guild.voice)
+    guild.voice_client = gp.voice
+    await gp.ensure_player_task(guild)
+    times = ", ".join(time.strftime("%H:%M", time.gmtime(time.time() + 60 * k)) for k in range(1, 6))
+    await stats.run("smoke set", bot.smoke_set.callback(FakeInteraction(guild), times, "UTC"))
+    if not shutil.which("ffmpeg"):  # the reminder clip needs ffmpeg to encode; post text only
+        await stats.run("smoke sound", bot.smoke_sound.callback(FakeInteraction(guild), "off"))
+    await stats.run("play", bot.play.callback(FakeInteraction(guild), "https://open.spotify.com/playlist/soak"))
+    actions = [("play", 40), ("queue", 30), ("skip", 15), ("smoke list", 10), ("shuffle", 5)]
+    names, weights = zip(*actions)
+    while True:
+        await asyncio.sleep(min(random.expovariate(1 / args.action_interval), max(0.0, deadline - time.monotonic())))
+        if time.monotonic() >= deadline:
+            break
+        name = random.choices(names, weights)[0]
+        inter = FakeInteraction(guild)
+        if name == "play":
+            query = ("https://open.spotify.com/playlist/soak" if random.random() < 0.2
+                     else f"song {random.randrange(args.catalog)}")
+            coro = bot.play.callback(inter, query)
+        elif name == "queue":
+            coro = bot.queue_cmd.callback(inter, random.randint(1, 3))
+        elif name == "skip":
+            coro = bot.skip_cmd.callback(inter)
+        elif name == "smoke list":
+            coro = bot.smoke_list.callback(inter)
+        else:
+            coro = bot.shuffle_cmd.callback(inter)
+        await stats.run(name, coro)
+
+
+def cpu_seconds() -> tuple[float, float]:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, kids.ru_utime + kids.ru_stime
+
+
+async def run(args) -> dict:
+    runner, port = await start_audio_server(args.track_seconds)
+    install_stubs(port, args)
+    guilds = {(i + 1) << 22: FakeGuild((i + 1) << 22) for i in range(args.guilds)}
+    channels = {g.text.id: g.text for g in guilds.values()}
+    bot.bot.get_guild = guilds.get
+    bot.bot.get_channel = channels.get
+
+    async def ready():
+        return None
+
+    bot.bot.wait_until_ready = ready
+    lag_task = asyncio.create_task(bot.watch_loop_lag())
+    bot.watchdog.start(asyncio.get_running_loop())
+    bot.smoke_sched.start()
+
+    stats = CommandStats()
+    cpu0, kids0 = cpu_seconds()
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(drive_guild(g, stats, args, deadline) for g in guilds.values()))
+    wall = time.monotonic() - started
+    cpu1, kids1 = cpu_seconds()
+
+    for gp in list(bot.players.values()):
+        gp.teardown()
+    for g in guilds.values():  # sinks call `after` on the loop; finish them before it closes
+        if g.voice_client is not None:
+            g.voice_client.stop()
+            await asyncio.to_thread(g.voice_client.join)
+    await asyncio.sleep(0)
+    lag_task.cancel()
+    await runner.cleanup()
+
+    cpu = (cpu1 - cpu0) + (kids1 - kids0)
+    streams = stream_seconds / wall if wall else 0.0  # average concurrent voice streams
+    return {
+        "config": {k: v for k, v in vars(args).items() if k != "out"},
+        "ffmpeg": bool(shutil.which("ffmpeg")),
+        "wall_s": wall,
+        "loop_lag": {**bot.loop_lag.snapshot(), "p99": bot.loop_lag.percentile(99)},
+        "stalls": [{"where": w, "leaf": leaf, "count": st["count"], "total_s": st["total"]}
+                   for (w, leaf), st in bot.watchdog.top(5)],
+        "cpu": {
+            "bot_s": cpu1 - cpu0,
+            "ffmpeg_s": kids1 - kids0,
+            "avg_concurrent_streams": streams,
+            "cores_per_stream": cpu / stream_seconds if stream_seconds else None,
+        },
+        "tracks_started": tracks_started,
+        "track_gaps": bot.track_gaps.snapshot(),
+        "ffmpeg_start": bot.ffmpeg_start.snapshot(),
+        "reminders": {"delivered": bot.reminder_dispatch.delivered, "failures": bot.reminder_dispatch.failures,
+                      "lateness": bot.reminder_dispatch.lateness.snapshot()},
+        "resolver": {k: v for k, v in bot.resolver.stats().items()},
+        "track_cache": {"hits": bot.track_cache.hits, "misses": bot.track_cache.misses},
+        "commands": {name: {**lat.snapshot(), "errors": stats.errors.get(name, 0)}
+                     for name, lat in sorted(stats.latency.items())},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=120, help="seconds to run")
+    parser.add_argument("--track-seconds", type=float, default=8)
+    parser.add_argument("--resolve-latency", type=float, default=0.8, help="mean stub yt-dlp latency (s)")
+    parser.add_argument("--action-interval", type=float, default=10, help="mean seconds between a guild's commands")
+    parser.add_argument("--catalog", type=int, default=500, help="distinct songs (controls cache hit rate)")
+    parser.add_argument("--playlist-max", type=int, default=20)
+    parser.add_argument("--out", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    text = json.dumps(asyncio.run(run(args)), indent=2, default=str)
+    if args.out:
+        Path(args.out).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,38 @@
 # (truncated message header for brevity)
 import asyncio
+import bisect
+import concurrent.futures
+import io
 import os
 import re
+import functools
+import hashlib
+import heapq
 import json
-from dataclasses import dataclass
-from typing import Optional, List
+import itertools
+import random
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Callable, Optional, List
+from urllib.parse import urlparse, parse_qs, urlencode
 
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
-import yt_dlp
-from spotipy import Spotify
-from spotipy.oauth2 import SpotifyClientCredentials
 from dotenv import load_dotenv
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 import aiohttp
+from aiohttp import web
 from pathlib import Path
 
 # Load .env if present
@@ -27,8 +42,21 @@ DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 
+# Sharding: SHARD_COUNT runs an AutoShardedBot ("auto" lets Discord pick the count);
+# SHARD_IDS/SHARD_GROUP are set per process by launcher.py
+SHARD_COUNT = os.getenv("SHARD_COUNT", "").strip().lower()
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+SHARD_GROUP = int(os.getenv("SHARD_GROUP", "0"))  # only group 0 syncs slash commands
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "").lower() in ("1", "true", "yes")
+
 INTENTS = discord.Intents.default()
-bot = commands.Bot(command_prefix="!", intents=INTENTS)
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=INTENTS,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT), shard_ids=SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=INTENTS)
 tree = bot.tree
 
 YDL_OPTS = {
@@ -45,41 +73,558 @@ FFMPEG_OPTS = {
     "options": "-vn",
 }
 
+# "opus": hand Opus to discord.py as-is (stream copy when the source is already Opus, else
+# FFmpeg encodes); "pcm": the old FFmpegPCMAudio path, where discord.py encodes in-process.
+PLAYBACK_MODE = os.getenv("PLAYBACK_MODE", "opus").lower()
+
+# Resolver pool: yt-dlp extraction runs here instead of on the event loop
+RESOLVER_WORKERS = int(os.getenv("RESOLVER_WORKERS", "4"))
+RESOLVER_MODE = os.getenv("RESOLVER_MODE", "thread")  # "thread" or "process"
+
+# Track cache: query -> video id, video id -> signed stream URL (+ its expiry)
+TRACK_CACHE_QUERIES = int(os.getenv("TRACK_CACHE_QUERIES", "5000"))
+TRACK_CACHE_STREAMS = int(os.getenv("TRACK_CACHE_STREAMS", "2000"))
+TRACK_CACHE_PATH = os.getenv("TRACK_CACHE_PATH")  # optional JSON file to persist the cache
+TRACK_CACHE_DB = os.getenv("TRACK_CACHE_DB")  # optional SQLite file shared by every bot process
+TRACK_CACHE_DB_MAX_AGE = 7 * 86400  # rows not written for this long are pruned
+TRACK_CACHE_DB_DELAY = 1.0  # seconds to batch new entries before writing them
+
+# /play autocomplete: trigram index over titles of tracks the bot has queued
+TRACK_INDEX_SIZE = int(os.getenv("TRACK_INDEX_SIZE", "20000"))  # tracks, all guilds
+TRACK_INDEX_PER_GUILD = 500  # recently queued tracks remembered per guild (ranked first)
+STREAM_URL_DEFAULT_TTL = 3600  # for URLs that don't carry an expire= param
+STREAM_URL_REFRESH_MARGIN = 120  # re-resolve if the URL expires within this many seconds
+
+# Lookahead prefetch: re-validate the next tracks' URLs and start the next FFmpeg early
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "2"))
+PREFETCH_WARM_LEAD = 20  # seconds before the current track ends to spawn the next FFmpeg
+
+# Local audio cache: tracks queued AUDIO_CACHE_MIN_PLAYS times are kept as Opus files on disk
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR")  # unset = off
+AUDIO_CACHE_BYTES = int(os.getenv("AUDIO_CACHE_BYTES", str(2 * 1024 * 1024 * 1024)))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_JOBS = 2  # background downloads at once
+AUDIO_CACHE_TIMEOUT = 600  # seconds per download
+AUDIO_CACHE_TRACKED = 100_000  # play counters kept for not-yet-cached tracks
+
+# Player lifecycle
+PLAYER_IDLE_TIMEOUT = int(os.getenv("PLAYER_IDLE_TIMEOUT", "600"))  # idle players are torn down after this
+VOICE_EMPTY_TIMEOUT = int(os.getenv("VOICE_EMPTY_TIMEOUT", "120"))  # leave a voice channel with no humans; 0 = never
+PLAYER_REAP_INTERVAL = 60
+QUEUE_MAX_TRACKS = int(os.getenv("QUEUE_MAX_TRACKS", "2000"))  # per guild
+QUEUE_PAGE_SIZE = 10
+
+# Queue snapshots: each guild's queue is saved so a redeploy can pick up where it left off
+PLAYER_SNAPSHOT_INTERVAL = int(os.getenv("PLAYER_SNAPSHOT_INTERVAL", "30"))  # seconds; 0 = off
+PLAYER_SNAPSHOT_MAX_AGE = int(os.getenv("PLAYER_SNAPSHOT_MAX_AGE", "1800"))  # older snapshots aren't restored
+PLAYER_RESTORE_CONCURRENCY = 4  # voice connects in flight while restoring
+
+# Spotify album/playlist expansion
+SPOTIFY_RESOLVE_CONCURRENCY = int(os.getenv("SPOTIFY_RESOLVE_CONCURRENCY", "6"))
+PROGRESS_EDIT_INTERVAL = 2.0  # seconds between /play progress message edits
+
+# Spotify Web API
+SPOTIFY_API = "https://api.spotify.com/v1"
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+SPOTIFY_PAGE_CONCURRENCY = int(os.getenv("SPOTIFY_PAGE_CONCURRENCY", "8"))
+SPOTIFY_META_CACHE = int(os.getenv("SPOTIFY_META_CACHE", "512"))  # cached API responses
+SPOTIFY_STATIC_MAX_AGE = 24 * 3600  # tracks/albums don't change; playlists always revalidate
+
+# Shared HTTP pool (Spotify, sound downloads, metadata fetches)
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))
+HTTP_PER_HOST_LIMIT = int(os.getenv("HTTP_PER_HOST_LIMIT", "10"))
+HTTP_DNS_TTL = 300  # seconds
+
+# Metrics: Prometheus text format on http://METRICS_HOST:METRICS_PORT/metrics (port + SHARD_GROUP when sharded)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 = off
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5  # seconds between event-loop lag probes
+LOOP_STALL_MS = int(os.getenv("LOOP_STALL_MS", "250"))  # loop blocked this long -> capture its stack; 0 = off
+LOOP_STALL_SITES = 200  # distinct stall sites kept for /debug stalls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
 SPOTIFY_URL_RE = re.compile(r"(https?://open\.spotify\.com/(track|album|playlist)/[A-Za-z0-9]+)")
 
+# === Shared helpers ===
+def owns_guild(gid: int) -> bool:
+    """True if guild `gid` lives on one of this process's shards."""
+    if SHARD_IDS is None:
+        return True  # single process, or an AutoShardedBot running every shard
+    return (gid >> 22) % int(SHARD_COUNT) in SHARD_IDS
+
+class LatencyStats:
+    """Rolling window of latency samples (seconds) with cheap percentiles.
+
+    Every sample is also counted into fixed histogram buckets, so the all-time
+    distribution can be exported to /metrics as a Prometheus histogram.
+    """
+    def __init__(self, window: int = 512, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.samples: deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)  # per bucket, not cumulative; > last bucket is count - sum
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.bucket_counts):
+            self.bucket_counts[i] += 1
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": max(self.samples) if self.samples else None,
+        }
+
+def _fmt_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    def esc(v) -> str:
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+class Metrics:
+    """Minimal Prometheus text-format registry.
+
+    Counters are incremented here, histograms are LatencyStats registered under a name,
+    and numbers that already live on other objects (gauges, existing counters) are read
+    at scrape time from callbacks returning a value or a {labels: value} dict.
+    """
+    def __init__(self):
+        self._meta: dict[str, tuple[str, str]] = {}  # name -> (type, help)
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, list[tuple[tuple, LatencyStats]]] = {}
+        self._callbacks: dict[str, Callable[[], object]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, amount: float = 1.0, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0.0) + amount
+
+    def histogram(self, name: str, stats: LatencyStats, help_text: str, **labels):
+        self.describe(name, "histogram", help_text)
+        self._histograms.setdefault(name, []).append((tuple(sorted(labels.items())), stats))
+
+    def gauge(self, name: str, help_text: str, fn: Callable[[], object], kind: str = "gauge"):
+        self.describe(name, kind, help_text)
+        self._callbacks[name] = fn
+
+    def render(self) -> str:
+        out: list[str] = []
+
+        def header(name: str):
+            kind, help_text = self._meta.get(name, ("counter", ""))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        for name, series in self._counters.items():
+            header(name)
+            out.extend(f"{name}{_fmt_labels(k)} {v:g}" for k, v in series.items())
+        for name, fn in self._callbacks.items():
+            try:
+                value = fn()
+            except Exception as e:
+                print(f"Metric {name} failed:", e)
+                continue
+            header(name)
+            if isinstance(value, dict):
+                out.extend(f"{name}{_fmt_labels(tuple(sorted(k)))} {float(v):g}" for k, v in value.items())
+            else:
+                out.append(f"{name} {float(value):g}")
+        for name, entries in self._histograms.items():
+            header(name)
+            for labels, st in entries:
+                cumulative = 0
+                for le, n in zip(st.buckets, st.bucket_counts):
+                    cumulative += n
+                    out.append(f"{name}_bucket{_fmt_labels(labels + (('le', f'{le:g}'),))} {cumulative}")
+                out.append(f"{name}_bucket{_fmt_labels(labels + (('le', '+Inf'),))} {st.count}")
+                out.append(f"{name}_sum{_fmt_labels(labels)} {st.total:g}")
+                out.append(f"{name}_count{_fmt_labels(labels)} {st.count}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+metrics.describe("dooberhut_errors_total", "counter", "Exceptions caught and logged, by where they happened")
+
+def log_error(where: str, e: BaseException):
+    """Print a swallowed exception and count it under dooberhut_errors_total{where=...}."""
+    print(f"{where} failed:", e)
+    metrics.inc("dooberhut_errors_total", where=where)
+
 # === Smoke Reminder Storage / Paths ===
 BASE_DIR = Path(os.path.dirname(__file__))
-SMOKE_STORE = str(BASE_DIR / "smoke_reminders.json")
+SMOKE_STORE = str(BASE_DIR / "smoke_reminders.json")  # legacy; imported into SMOKE_DB once
+SMOKE_DB = os.getenv("SMOKE_DB", str(BASE_DIR / "smoke_reminders.db"))
+SMOKE_SAVE_DELAY = 1.0  # seconds; config changes inside this window go out in one transaction
+SMOKE_RETRY_MAX = 60.0  # failed saves back off up to this many seconds between attempts
 DEFAULT_TZ = "UTC"
+DEFAULT_SMOKE_MESSAGE = "🚬 Time to smoke!"
+SMOKE_MAX_SLEEP = 300  # scheduler re-checks the wall clock at least this often
+SMOKE_RETRY_DELAY = 60  # interval reminder that couldn't post (channel gone etc.) retries after this
+SMOKE_DISPATCH_WORKERS = int(os.getenv("SMOKE_DISPATCH_WORKERS", "16"))  # reminders delivered in parallel
+SMOKE_SEND_RATE = float(os.getenv("SMOKE_SEND_RATE", "40"))  # msgs/s across guilds; Discord's global cap is 50/s
+SMOKE_SEND_RETRIES = 3
 REMINDER_BEEP = str(BASE_DIR / "assets" / "reminder_beep.wav")
 ASSETS_DIR = BASE_DIR / "assets"
 ASSETS_DIR.mkdir(exist_ok=True)
 
 ALLOWED_AUDIO_EXTS = {".wav", ".mp3", ".ogg", ".opus", ".m4a", ".webm"}
+REMINDER_CACHE_BYTES = int(os.getenv("REMINDER_CACHE_BYTES", str(16 * 1024 * 1024)))  # pre-encoded clips kept in RAM
+SOUNDS_DIR = ASSETS_DIR / "sounds"  # custom reminder sounds, stored as <sha256>.dat
+SOUND_MAX_BYTES = 15 * 1024 * 1024
+DOWNLOAD_CHUNK = 256 * 1024
 
 def guild_sound_path(gid: int) -> Path:
     return ASSETS_DIR / f"smoke_custom_{gid}.dat"  # container; FFmpeg will sniff
 
-# {guild_id: {"channel_id": int, "times": ["HH:MM", ...], "tz": "Area/City", "message": str,
-#             "last_fired": { "YYYYMMDDHHMM": True }, "interval_minutes": int|None, "interval_last_ts": int|None,
-#             "sound": bool, "sound_path": str|None }}
-smoke_cfg: dict[int, dict] = {}
+# === Downloads ===
+class DownloadError(Exception):
+    """Download refused or failed; the message is safe to show to the user."""
+
+class HttpPool:
+    """The bot's one aiohttp session: keep-alive pool, DNS cache and per-host limits.
+
+    Opened in setup_hook (or lazily on first use) and shared by everything that talks
+    HTTP, so repeated requests reuse warm TLS connections. A trace hook keeps per-host
+    request counts, errors, in-flight requests and latency.
+    """
+    def __init__(self, limit: int, per_host: int):
+        self.limit = limit
+        self.per_host = per_host
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.hosts: dict[str, dict] = {}
+
+    def _host(self, host: Optional[str]) -> dict:
+        host = host or "?"
+        st = self.hosts.get(host)
+        if st is None:
+            st = self.hosts[host] = {"requests": 0, "errors": 0, "in_flight": 0, "latency": LatencyStats(window=256)}
+            metrics.histogram("dooberhut_http_request_seconds", st["latency"], "Request latency through the shared HTTP pool", host=host)
+        return st
+
+    async def _on_start(self, session, ctx, params):
+        ctx.started = time.monotonic()
+        ctx.host = params.url.host
+        self._host(ctx.host)["in_flight"] += 1
+
+    async def _on_end(self, session, ctx, params):
+        st = self._host(ctx.host)
+        st["in_flight"] -= 1
+        st["requests"] += 1
+        st["latency"].observe(time.monotonic() - ctx.started)
+
+    async def _on_error(self, session, ctx, params):
+        st = self._host(ctx.host)
+        st["in_flight"] -= 1
+        st["errors"] += 1
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_start)
+            trace.on_request_end.append(self._on_end)
+            trace.on_request_exception.append(self._on_error)
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.per_host,
+                use_dns_cache=True, ttl_dns_cache=HTTP_DNS_TTL, keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, trace_configs=[trace],
+                timeout=aiohttp.ClientTimeout(total=60, sock_read=20),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def stats(self) -> dict:
+        return {
+            "in_use": sum(st["in_flight"] for st in self.hosts.values()),
+            "limit": self.limit,
+            "hosts": {
+                host: {"requests": st["requests"], "errors": st["errors"], "in_flight": st["in_flight"],
+                       "p50": st["latency"].percentile(50), "p95": st["latency"].percentile(95)}
+                for host, st in self.hosts.items()
+            },
+        }
+
+http = HttpPool(HTTP_POOL_LIMIT, HTTP_PER_HOST_LIMIT)
+
+def http_session() -> aiohttp.ClientSession:
+    return http.session()
+
+async def download_sound(url: str, max_bytes: int = SOUND_MAX_BYTES) -> Path:
+    """Stream `url` into SOUNDS_DIR and return its content-addressed path.
+
+    The byte cap is enforced while streaming (Content-Length is only an early reject),
+    chunks are hashed and written off the loop into a temp file, and the finished file is
+    renamed into place atomically. Identical uploads from different guilds share one file.
+    """
+    loop = asyncio.get_running_loop()
+    SOUNDS_DIR.mkdir(exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=SOUNDS_DIR, suffix=".part")
+    f = os.fdopen(fd, "wb")
+    digest = hashlib.sha256()
+    def write(chunk: bytes):
+        digest.update(chunk)
+        f.write(chunk)
+    try:
+        async with http_session().get(url) as resp:
+            if resp.status != 200:
+                raise DownloadError(f"Could not download the file (HTTP {resp.status}).")
+            if int(resp.headers.get("Content-Length") or 0) > max_bytes:
+                raise DownloadError(f"File too large (>{max_bytes // (1024 * 1024)}MB).")
+            size = 0
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise DownloadError(f"File too large (>{max_bytes // (1024 * 1024)}MB).")
+                await loop.run_in_executor(None, write, chunk)
+        await loop.run_in_executor(None, _fsync_close, f)
+        final = SOUNDS_DIR / f"{digest.hexdigest()}.dat"
+        if final.exists():
+            os.remove(tmp)  # same bytes already stored for some guild
+        else:
+            os.replace(tmp, final)
+        return final
+    except BaseException:
+        f.close()
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def _fsync_close(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+async def release_sound(path: Optional[str], gid: int):
+    """Forget guild `gid`'s custom sound file, deleting it unless another guild uses it too."""
+    if not path:
+        return
+    if any(c.sound_path == path for g, c in smoke_cfg.items() if g != gid):
+        return
+    if SHARD_IDS is not None:
+        try:
+            # the db is shared with (and written by) the other shard processes; query it off the loop
+            in_use = await asyncio.get_running_loop().run_in_executor(
+                smoke_store._executor, smoke_store.sound_in_use, path, gid
+            )
+        except Exception as e:
+            log_error("Sound reference check", e)
+            return
+        if in_use:
+            return  # a guild on another shard process shares the file
+    reminder_sounds.invalidate(path)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+@dataclass(slots=True)
+class SmokeConfig:
+    channel_id: Optional[int] = None
+    times: List[str] = field(default_factory=list)  # ["HH:MM", ...]
+    tz: str = DEFAULT_TZ
+    message: str = DEFAULT_SMOKE_MESSAGE
+    # "HH:MM" -> epoch minute it last fired; one int per scheduled time is all the dedup we need
+    last_fired: dict[str, int] = field(default_factory=dict)
+    interval_minutes: Optional[int] = None
+    interval_last_ts: Optional[int] = None
+    sound: bool = True
+    sound_path: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "SmokeConfig":
+        cfg = cls(
+            channel_id=d.get("channel_id"),
+            times=list(d.get("times") or []),
+            tz=d.get("tz") or DEFAULT_TZ,
+            message=d.get("message") or DEFAULT_SMOKE_MESSAGE,
+            interval_minutes=d.get("interval_minutes"),
+            interval_last_ts=d.get("interval_last_ts"),
+            sound=d.get("sound", True),
+            sound_path=d.get("sound_path"),
+        )
+        for key, val in (d.get("last_fired") or {}).items():
+            if len(key) == 12:
+                # legacy {"YYYYMMDDHHMM": True} ledger -> latest epoch minute per HH:MM
+                hhmm = f"{key[8:10]}:{key[10:12]}"
+                local = datetime(int(key[:4]), int(key[4:6]), int(key[6:8]), int(key[8:10]), int(key[10:12]),
+                                 tzinfo=zone(cfg.tz))
+                val = int(local.timestamp() // 60)
+                key = hhmm
+            if key in cfg.times:
+                cfg.last_fired[key] = max(int(val), cfg.last_fired.get(key, 0))
+        return cfg
+
+smoke_cfg: dict[int, SmokeConfig] = {}
+
+def get_smoke_cfg(gid: int) -> SmokeConfig:
+    cfg = smoke_cfg.get(gid)
+    if cfg is None:
+        cfg = smoke_cfg[gid] = SmokeConfig()
+    return cfg
+
+class SmokeStore:
+    """SQLite (WAL) storage for smoke_cfg, one row per guild.
+
+    Changed guilds are marked dirty and flushed together after SMOKE_SAVE_DELAY on a
+    dedicated writer thread, so a burst of fires or commands costs one transaction (one
+    fsync) and the event loop never touches the disk. A crash mid-write leaves the
+    previous committed state intact.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="smoke-store")
+        self._conn: Optional[sqlite3.Connection] = None  # owned by the writer thread
+        self._dirty: set[int] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self.save_time = LatencyStats()
+        self.failures = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("CREATE TABLE IF NOT EXISTS smoke (gid INTEGER PRIMARY KEY, data TEXT NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        return conn
+
+    def load(self) -> dict[int, dict]:
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT gid, data FROM smoke").fetchall()
+            if not rows and os.path.exists(SMOKE_STORE):
+                with open(SMOKE_STORE, "r") as f:
+                    legacy = json.load(f)
+                rows = [(int(k), json.dumps(v)) for k, v in legacy.items()]
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO smoke (gid, data) VALUES (?, ?)", rows)
+                print(f"Imported {len(rows)} smoke config(s) from {SMOKE_STORE}")
+            cfgs = {int(gid): SmokeConfig.from_dict(json.loads(data)) for gid, data in rows}
+            # write back anything from_dict migrated (old last_fired ledgers)
+            migrated = [(gid, json.dumps(cfgs[int(gid)].to_dict())) for gid, data in rows
+                        if json.dumps(cfgs[int(gid)].to_dict()) != data]
+            if migrated:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO smoke (gid, data) VALUES (?, ?)", migrated)
+            # other shard processes own (and write) the rest of the table
+            return {gid: cfg for gid, cfg in cfgs.items() if owns_guild(gid)}
+        finally:
+            conn.close()
+
+    def sound_in_use(self, path: str, exclude_gid: int) -> bool:
+        """Whether any other guild's saved config, including other processes' guilds, uses `path`."""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            row = conn.execute(
+                "SELECT 1 FROM smoke WHERE gid != ? AND json_extract(data, '$.sound_path') = ? LIMIT 1",
+                (exclude_gid, path),
+            ).fetchone()
+            return row is not None
+        finally:
+            conn.close()
+
+    def mark_dirty(self, gid: int):
+        self._dirty.add(gid)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # keep going until nothing is dirty: guilds changed while a write was in flight
+        # (mark_dirty sees this task still running) go out in the next pass
+        delay = SMOKE_SAVE_DELAY
+        while self._dirty:
+            await asyncio.sleep(delay)
+            delay = SMOKE_SAVE_DELAY if await self.flush() else min(delay * 2, SMOKE_RETRY_MAX)
+
+    def _snapshot(self) -> tuple[set[int], list[tuple[int, str]], list[tuple[int]]]:
+        gids, self._dirty = self._dirty, set()
+        rows = [(gid, json.dumps(smoke_cfg[gid].to_dict())) for gid in gids if gid in smoke_cfg]
+        gone = [(gid,) for gid in gids if gid not in smoke_cfg]
+        return gids, rows, gone
+
+    def _write(self, rows: list[tuple[int, str]], gone: list[tuple[int]]):
+        if self._conn is None:
+            self._conn = self._connect()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO smoke (gid, data) VALUES (?, ?) ON CONFLICT(gid) DO UPDATE SET data = excluded.data", rows
+            )
+            self._conn.executemany("DELETE FROM smoke WHERE gid = ?", gone)
+
+    async def flush(self) -> bool:
+        """Write the dirty guilds; returns False (and keeps them dirty) if the write failed."""
+        if not self._dirty:
+            return True
+        gids, rows, gone = self._snapshot()  # serialize on the loop so the writer sees a consistent copy
+        started = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, rows, gone)
+            return True
+        except Exception as e:
+            self.failures += 1
+            log_error("Smoke config save", e)
+            self._dirty |= gids  # _flush_later retries them after a backoff
+            return False
+        finally:
+            self.save_time.observe(time.monotonic() - started)
+
+    def _meta(self, key: str, value: Optional[str] = None) -> Optional[str]:
+        if self._conn is None:
+            self._conn = self._connect()
+        if value is None:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else None
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        return value
+
+    async def get_meta(self, key: str) -> Optional[str]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._meta, key)
+
+    async def set_meta(self, key: str, value: str):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._meta, key, value)
+
+    def flush_sync(self):
+        """Write anything still pending; used at shutdown after the loop has stopped."""
+        if self._dirty:
+            _, rows, gone = self._snapshot()
+            self._executor.submit(self._write, rows, gone).result()
+
+smoke_store = SmokeStore(SMOKE_DB)
 
 def load_smoke():
     global smoke_cfg
     try:
-        with open(SMOKE_STORE, "r") as f:
-            smoke_cfg = json.load(f)
-            smoke_cfg = {int(k): v for k, v in smoke_cfg.items()}
-    except Exception:
+        smoke_cfg = smoke_store.load()
+    except Exception as e:
+        print("Smoke config load failed:", e)
         smoke_cfg = {}
 
-def save_smoke():
-    try:
-        with open(SMOKE_STORE, "w") as f:
-            json.dump(smoke_cfg, f)
-    except Exception:
-        pass
+def save_smoke(gid: int):
+    smoke_store.mark_dirty(gid)
 
 def parse_timestrings(times_str: str):
     out = []
@@ -95,15 +640,131 @@ def parse_timestrings(times_str: str):
             out.append(f"{hh:02d}:{mm:02d}")
     return out
 
-def now_in_tz(tz_name: str):
+@functools.lru_cache(maxsize=512)
+def zone(tz_name: str) -> ZoneInfo:
     try:
-        tz = ZoneInfo(tz_name)
+        return ZoneInfo(tz_name)
     except Exception:
-        tz = ZoneInfo("UTC")
-    return datetime.now(tz)
+        return ZoneInfo("UTC")
+
+def now_in_tz(tz_name: str):
+    return datetime.now(zone(tz_name))
+
+def next_daily_fire(times: List[str], tz_name: str, after_ts: float) -> Optional[float]:
+    """First instant (unix ts) strictly after `after_ts` whose local wall time is in `times`.
+
+    Ambiguous wall times (DST fall-back) fire on their first occurrence; wall times that
+    don't exist (spring-forward gap) are skipped for that day, same as the old minute scan.
+    """
+    tz = zone(tz_name)
+    today = datetime.fromtimestamp(after_ts, tz).date()
+    for day in range(3):
+        d = today + timedelta(days=day)
+        best = None
+        for hhmm in times:
+            hh, mm = int(hhmm[:2]), int(hhmm[3:5])
+            naive = datetime(d.year, d.month, d.day, hh, mm)
+            ts = naive.replace(tzinfo=tz).timestamp()
+            if datetime.fromtimestamp(ts, tz).replace(tzinfo=None) != naive:
+                continue
+            if ts > after_ts and (best is None or ts < best):
+                best = ts
+        if best is not None:
+            return best
+    return None
+
+def _resolve_future(fut: asyncio.Future, result=None):
+    # `after` callbacks run on discord.py's audio thread; hop back to the loop first.
+    if not fut.done():
+        fut.set_result(result)
+
+class OpusFrameSource(discord.AudioSource):
+    """Plays already-encoded Opus packets from memory, so no FFmpeg process is spawned."""
+    def __init__(self, frames: List[bytes]):
+        self._frames = iter(frames)
+
+    def read(self) -> bytes:
+        return next(self._frames, b"")
+
+    def is_opus(self) -> bool:
+        return True
+
+def _ogg_to_opus_frames(data: bytes) -> List[bytes]:
+    packets = discord.oggparse.OggStream(io.BytesIO(data)).iter_packets()
+    return [p for p in packets if not p.startswith((b"OpusHead", b"OpusTags"))]
+
+class ReminderSoundCache:
+    """Reminder clips transcoded once to 20 ms Opus frames, held in a byte-bounded LRU.
+
+    Entries are keyed by (path, mtime) so re-uploading a guild's sound is picked up, and
+    concurrent requests for the same clip share a single FFmpeg run.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: "OrderedDict[tuple[str, int], tuple[List[bytes], int]]" = OrderedDict()
+        self._loading: dict[tuple[str, int], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, path: str) -> List[bytes]:
+        key = (path, os.stat(path).st_mtime_ns)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        task = self._loading.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._loading[key] = asyncio.create_task(self._load(key, path))
+        return await asyncio.shield(task)
+
+    async def _load(self, key: tuple[str, int], path: str) -> List[bytes]:
+        try:
+            frames = await self._encode(path)
+            self._store(key, frames)
+            return frames
+        finally:
+            self._loading.pop(key, None)
+
+    def _store(self, key: tuple[str, int], frames: List[bytes]):
+        size = sum(len(f) for f in frames)
+        if size > self.max_bytes:
+            return  # too big to keep; it still plays, just gets re-encoded next time
+        self._entries[key] = (frames, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, old_size) = self._entries.popitem(last=False)
+            self.bytes -= old_size
+
+    def invalidate(self, path: str):
+        for key in [k for k in self._entries if k[0] == path]:
+            self.bytes -= self._entries.pop(key)[1]
+
+    async def _encode(self, path: str) -> List[bytes]:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-i", path, "-vn", "-map_metadata", "-1",
+            "-f", "opus", "-c:a", "libopus", "-ar", "48000", "-ac", "2", "-b:a", "96k", "pipe:1",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        data, _ = await proc.communicate()
+        if proc.returncode != 0 or not data:
+            raise RuntimeError(f"ffmpeg could not encode {path}")
+        return await asyncio.to_thread(_ogg_to_opus_frames, data)
+
+    def prewarm(self, path: str):
+        async def run():
+            try:
+                await self.get(path)
+            except Exception as e:
+                print("Reminder sound pre-encode failed:", e)
+        asyncio.create_task(run())
+
+reminder_sounds = ReminderSoundCache(REMINDER_CACHE_BYTES)
 
 async def play_beep_in_voice(guild: discord.Guild):
-    """Play the guild's custom sound (or default beep) if voice is connected and idle."""
+    """Start the guild's custom sound (or default beep) if voice is connected and idle; doesn't wait for it to end."""
     vc = guild.voice_client
     if not vc or not vc.is_connected():
         return False
@@ -111,129 +772,1245 @@ async def play_beep_in_voice(guild: discord.Guild):
         return False  # don't interrupt music
 
     # choose sound file
-    custom_path = smoke_cfg.get(guild.id, {}).get("sound_path")
+    cfg = smoke_cfg.get(guild.id)
+    custom_path = cfg.sound_path if cfg else None
     sound_file = custom_path if (custom_path and os.path.exists(custom_path)) else REMINDER_BEEP
     if not sound_file or not os.path.exists(sound_file):
         return False
 
     try:
-        source = discord.FFmpegPCMAudio(sound_file, **FFMPEG_OPTS)
-        vc.play(source)
-        # wait up to ~2s for short clip to finish
-        for _ in range(40):
-            if not vc.is_playing():
-                break
-            await asyncio.sleep(0.05)
+        frames = await reminder_sounds.get(sound_file)
+        if vc.is_playing() or vc.is_paused() or not vc.is_connected():
+            return False  # music started while the clip was being encoded
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        vc.play(OpusFrameSource(frames), after=lambda err: loop.call_soon_threadsafe(_resolve_future, done, err))
+        # music queued meanwhile waits on this instead of colliding with the clip, so there's
+        # no need to hold a dispatcher worker until it ends
+        get_player(guild).sfx_done = done
         return True
-    except Exception:
+    except Exception as e:
+        log_error("reminder_sound", e)
         return False
 
-@tasks.loop(seconds=30)
-async def smoke_tick():
-    for gid, cfg in list(smoke_cfg.items()):
-        try:
-            channel_id = cfg.get("channel_id")
-            times = cfg.get("times") or []
-            tzname = cfg.get("tz") or DEFAULT_TZ
-            msg = cfg.get("message") or "🚬 Time to smoke!"
-            last_fired = cfg.setdefault("last_fired", {})
-            interval_minutes = cfg.get("interval_minutes")
-            interval_last_ts = cfg.get("interval_last_ts")
-            sound_on = cfg.get("sound", True)
-
-            if not channel_id:
-                continue
-            ch = bot.get_channel(int(channel_id))
-            if ch is None:
-                continue
-
-            now = now_in_tz(tzname)
-            key_min = now.strftime("%Y%m%d%H%M")
-            current_hhmm = now.strftime("%H:%M")
-
-            fired = False
-
-            # Mode A: specific daily times
-            if times:
-                if current_hhmm in times and key_min not in last_fired:
-                    # Send text
-                    await ch.send(msg)
-                    # Try sound (only if in voice & idle)
-                    guild = bot.get_guild(gid)
+class TokenBucket:
+    """Simple token bucket; `acquire` waits until a token is available."""
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class ReminderDispatcher:
+    """Bounded worker pool that delivers due reminders concurrently.
+
+    Per-route buckets are honoured by discord.py's HTTP client (each channel is its own
+    route), so one slow or limited channel only holds up its own worker; the shared token
+    bucket keeps a mass fire under the global request limit.
+    """
+    def __init__(self, workers: int, rate: float):
+        self.workers = max(1, workers)
+        self.bucket = TokenBucket(rate)
+        self._queue: asyncio.Queue[tuple[int, float]] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self.in_flight: set[int] = set()  # guilds queued or being delivered; the scheduler leaves them alone
+        self.lateness = LatencyStats()  # delivered - scheduled, seconds
+        self.delivered = 0
+        self.rate_limited = 0
+        self.failures = 0
+
+    def start(self):
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    def submit(self, gid: int, due: float):
+        self.in_flight.add(gid)
+        self._queue.put_nowait((gid, due))
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            gid, due = await self._queue.get()
+            try:
+                await fire_smoke(gid, due)
+            finally:
+                self.in_flight.discard(gid)
+                smoke_sched.reschedule(gid, after_ts=due)
+
+    async def send(self, ch: discord.abc.Messageable, msg: str):
+        for attempt in range(SMOKE_SEND_RETRIES + 1):
+            await self.bucket.acquire()
+            try:
+                return await ch.send(msg)
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    self.rate_limited += 1
+                if attempt == SMOKE_SEND_RETRIES or not (e.status == 429 or e.status >= 500):
+                    raise
+                await asyncio.sleep(min(30, 2 ** attempt) * random.uniform(0.5, 1.5))
+
+reminder_dispatch = ReminderDispatcher(SMOKE_DISPATCH_WORKERS, SMOKE_SEND_RATE)
+
+async def fire_smoke(gid: int, due: float):
+    """Deliver one guild's reminder that the scheduler says is due at `due`."""
+    cfg = smoke_cfg.get(gid)
+    if not cfg:
+        return
+    try:
+        channel_id = cfg.channel_id
+        times = cfg.times
+        msg = cfg.message or DEFAULT_SMOKE_MESSAGE
+        interval_minutes = cfg.interval_minutes
+        interval_last_ts = cfg.interval_last_ts
+        sound_on = cfg.sound
+
+        if not channel_id:
+            return
+        ch = bot.get_channel(int(channel_id))
+        if ch is None:
+            return
+
+        fired = False
+
+        # Mode A: specific daily times
+        if times:
+            hhmm = datetime.fromtimestamp(due, zone(cfg.tz or DEFAULT_TZ)).strftime("%H:%M")
+            minute = int(due // 60)
+            if cfg.last_fired.get(hhmm, -1) < minute:
+                # Send text
+                await reminder_dispatch.send(ch, msg)
+                # Try sound (only if in voice & idle)
+                guild = bot.get_guild(gid)
+                if sound_on and guild:
+                    await play_beep_in_voice(guild)
+                cfg.last_fired = {t: m for t, m in cfg.last_fired.items() if t in times}
+                cfg.last_fired[hhmm] = minute
+                fired = True
+
+        # Mode B: interval minutes (only while bot is in voice chat)
+        elif isinstance(interval_minutes, int) and interval_minutes > 0:
+            guild = bot.get_guild(gid)
+            voice_ok = guild and guild.voice_client and guild.voice_client.is_connected()
+            if voice_ok:
+                now_ts = int(time.time())
+                if not interval_last_ts:
+                    elapsed = True
+                else:
+                    elapsed = (now_ts - int(interval_last_ts)) >= (interval_minutes * 60)
+                if elapsed:
+                    # Prefer sound when idle; otherwise post text
+                    did_sound = False
                     if sound_on and guild:
-                        await play_beep_in_voice(guild)
-                    last_fired[key_min] = True
+                        did_sound = await play_beep_in_voice(guild)
+                    if not did_sound:
+                        await reminder_dispatch.send(ch, msg)
+                    cfg.interval_last_ts = int(now_ts)
                     fired = True
 
-            # Mode B: interval minutes (only while bot is in voice chat)
-            elif isinstance(interval_minutes, int) and interval_minutes > 0:
-                guild = bot.get_guild(gid)
-                voice_ok = guild and guild.voice_client and guild.voice_client.is_connected()
-                if voice_ok:
-                    now_ts = int(now.timestamp())
-                    due = False
-                    if not interval_last_ts:
-                        due = True
-                    else:
-                        due = (now_ts - int(interval_last_ts)) >= (interval_minutes * 60)
-                    if due:
-                        # Prefer sound when idle; otherwise post text
-                        did_sound = False
-                        if sound_on and guild:
-                            did_sound = await play_beep_in_voice(guild)
-                        if not did_sound:
-                            await ch.send(msg)
-                        cfg["interval_last_ts"] = int(now_ts)
-                        fired = True
-
-            if fired:
-                if len(last_fired) > 5000:
-                    for k in sorted(last_fired.keys())[:-2000]:
-                        last_fired.pop(k, None)
-                save_smoke()
-        except Exception:
-            continue
+        if fired:
+            reminder_dispatch.delivered += 1
+            reminder_dispatch.lateness.observe(max(0.0, time.time() - due))
+            save_smoke(gid)
+    except Exception as e:
+        reminder_dispatch.failures += 1
+        log_error("reminder_fire", e)
+
+def next_smoke_fire(gid: int, after_ts: Optional[float] = None) -> Optional[float]:
+    """When guild `gid` should next fire, or None if nothing is scheduled.
+
+    `after_ts` is the deadline that was just handled; without it (config change,
+    startup) the current minute still counts, so a reminder due right now isn't lost.
+    """
+    cfg = smoke_cfg.get(gid)
+    if not cfg or not cfg.channel_id:
+        return None
+    now = time.time()
+    if cfg.times:
+        after = after_ts if after_ts is not None else (now // 60) * 60 - 1
+        return next_daily_fire(cfg.times, cfg.tz or DEFAULT_TZ, after)
+    interval_minutes = cfg.interval_minutes
+    if isinstance(interval_minutes, int) and interval_minutes > 0:
+        # voice-gated: nothing to wait for until the bot is in voice (on_voice_state_update reschedules)
+        guild = bot.get_guild(gid)
+        if not (guild and guild.voice_client and guild.voice_client.is_connected()):
+            return None
+        last = cfg.interval_last_ts
+        due = int(last) + interval_minutes * 60 if last else now
+        if after_ts is not None:
+            due = max(due, after_ts + SMOKE_RETRY_DELAY)
+        return due
+    return None
+
+class SmokeScheduler:
+    """Min-heap of every guild's next reminder instant.
+
+    The loop sleeps until the earliest deadline (or until woken by a config change),
+    so firing costs O(log n) instead of a 30 s scan over all guilds. Each guild has a
+    version number; rescheduling bumps it and older heap entries are dropped when popped.
+    """
+    def __init__(self):
+        self._heap: list[tuple[float, int, int]] = []  # (due_ts, version, gid)
+        self._version: dict[int, int] = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def reschedule(self, gid: int, after_ts: Optional[float] = None):
+        ver = self._version.get(gid, 0) + 1
+        self._version[gid] = ver
+        if gid in reminder_dispatch.in_flight:
+            # last_fired isn't stamped until delivery finishes, so scheduling now would queue
+            # the same minute again; the worker reschedules (with the new config) when done
+            return
+        due = next_smoke_fire(gid, after_ts)
+        if due is None:
+            return
+        heapq.heappush(self._heap, (due, ver, gid))
+        if self._heap[0] == (due, ver, gid):
+            self._wake.set()
+        if len(self._heap) > 2 * len(self._version) + 64:
+            self._heap = [e for e in self._heap if self._version.get(e[2]) == e[1]]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        for gid in list(smoke_cfg):
+            self.reschedule(gid)
+        reminder_dispatch.start()
+        self._task = asyncio.create_task(self._run())
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    async def _run(self):
+        await bot.wait_until_ready()
+        while True:
+            while self._heap and self._heap[0][0] <= time.time():
+                due, ver, gid = heapq.heappop(self._heap)
+                if self._version.get(gid) != ver:
+                    continue
+                # the dispatcher reschedules the guild once delivery finishes
+                reminder_dispatch.submit(gid, due)
+            delay = self._heap[0][0] - time.time() if self._heap else SMOKE_MAX_SLEEP
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=min(max(delay, 0), SMOKE_MAX_SLEEP))
+            except asyncio.TimeoutError:
+                pass
+
+smoke_sched = SmokeScheduler()
 
-@smoke_tick.before_loop
-async def before_smoke_tick():
-    await bot.wait_until_ready()
+def smoke_changed(gid: int):
+    """Persist and reschedule after a /smoke command changed a guild's config."""
+    save_smoke(gid)
+    smoke_sched.reschedule(gid)
 
 load_smoke()
 
+# ===== Resolver pool =====
+def _slim_info(info: Optional[dict]) -> Optional[dict]:
+    """Keep only the fields we use; full yt-dlp info dicts are large and slow to pickle."""
+    if info is None:
+        return None
+    if "entries" in info:
+        entries = [e for e in (info["entries"] or []) if e]
+        if not entries:
+            return None
+        info = entries[0]
+    return {k: info.get(k) for k in ("id", "title", "url", "webpage_url", "duration", "acodec")}
+
+_ydl_local = threading.local()
+
+def _ydl_extract(query: str) -> Optional[dict]:
+    # Runs inside the resolver pool (worker thread or child process), never on the loop.
+    # One YoutubeDL per worker, kept alive so its HTTP connections are reused.
+    ydl = getattr(_ydl_local, "ydl", None)
+    if ydl is None:
+        import yt_dlp  # heavy (hundreds of extractor modules); only paid once a lookup happens
+        ydl = _ydl_local.ydl = yt_dlp.YoutubeDL(YDL_OPTS)
+    return _slim_info(ydl.extract_info(query, download=False))
+
+class ResolverPool:
+    """Bounded pool for yt-dlp extraction with per-guild round-robin fairness.
+
+    Each guild gets its own FIFO; workers take one job from each guild in turn, so a
+    guild expanding a 100-track playlist can't starve another guild's single /play.
+    """
+    def __init__(self, workers: int, mode: str = "thread"):
+        self.workers = max(1, workers)
+        self.mode = mode
+        self._executor: Optional[concurrent.futures.Executor] = None
+        self._pending: dict[int, deque] = {}
+        self._ready: deque[int] = deque()  # guilds with pending jobs, in round-robin order
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+        self.in_flight = 0
+        self.failures = 0
+        self.wait_time = LatencyStats()  # queued -> picked up by a worker
+        self.run_time = LatencyStats()   # time spent inside yt-dlp
+
+    def _start(self):
+        if self._tasks:
+            return
+        if self.mode == "process":
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="resolver"
+            )
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    async def extract(self, guild_id: int, query: str) -> Optional[dict]:
+        self._start()
+        fut = asyncio.get_running_loop().create_future()
+        jobs = self._pending.get(guild_id)
+        if jobs is None:
+            jobs = self._pending[guild_id] = deque()
+            self._ready.append(guild_id)
+        jobs.append((query, fut, time.monotonic()))
+        self._wakeup.set()
+        return await fut
+
+    def _next_job(self):
+        while self._ready:
+            gid = self._ready.popleft()
+            jobs = self._pending[gid]
+            job = jobs.popleft()
+            if jobs:
+                self._ready.append(gid)
+            else:
+                del self._pending[gid]
+            if not job[1].cancelled():
+                return job
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            query, fut, queued_at = job
+            started = time.monotonic()
+            self.wait_time.observe(started - queued_at)
+            self.in_flight += 1
+            try:
+                info = await loop.run_in_executor(self._executor, _ydl_extract, query)
+            except Exception as e:
+                self.failures += 1
+                if not fut.done():
+                    fut.set_exception(e)
+            else:
+                if not fut.done():
+                    fut.set_result(info)
+            finally:
+                self.in_flight -= 1
+                self.run_time.observe(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "mode": self.mode,
+            "queue_depth": self.queue_depth,
+            "guilds_waiting": len(self._pending),
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "wait": self.wait_time.snapshot(),
+            "run": self.run_time.snapshot(),
+        }
+
+resolver = ResolverPool(RESOLVER_WORKERS, RESOLVER_MODE)
+
+# ===== Resolved-track cache =====
+def stream_url_expiry(url: str) -> float:
+    """Expiry (unix ts) of a signed stream URL; googlevideo puts it in expire= or /expire/<ts>/."""
+    try:
+        parsed = urlparse(url)
+        qs = parse_qs(parsed.query)
+        if qs.get("expire"):
+            return float(qs["expire"][0])
+        m = re.search(r"/expire/(\d+)", parsed.path)
+        if m:
+            return float(m.group(1))
+    except Exception:
+        pass
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+def normalize_query(query: str) -> str:
+    if query.startswith("http"):
+        return query.strip()  # video ids are case-sensitive
+    return " ".join(query.lower().split())
+
+@dataclass
+class StreamEntry:
+    video_id: str
+    url: str
+    expires_at: float
+    title: str
+    webpage_url: Optional[str] = None
+    duration: Optional[float] = None
+    acodec: Optional[str] = None
+
+    def fresh(self, margin: float = STREAM_URL_REFRESH_MARGIN) -> bool:
+        return self.expires_at - time.time() > margin
+
+class TrackCache:
+    """Two LRU tiers: normalized query -> video id, and video id -> stream URL entry.
+
+    Stream entries are kept after their URL expires: the metadata and webpage_url still
+    let us re-resolve the exact video without repeating the search.
+
+    With `db` set, new entries are also written (batched, off the loop) to a SQLite file
+    that every shard process shares, and `fetch` falls back to it on a local miss, so a
+    song resolved by one process is a cache hit in all of them.
+    """
+    def __init__(self, max_queries: int, max_streams: int, path: Optional[str] = None, db: Optional[str] = None):
+        self.max_queries = max_queries
+        self.max_streams = max_streams
+        self.path = path
+        self.queries: "OrderedDict[str, str]" = OrderedDict()
+        self.streams: "OrderedDict[str, StreamEntry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self.dirty = False
+        self.db = db
+        self._db_conn: Optional[sqlite3.Connection] = None  # owned by the db thread
+        self._db_executor = (
+            concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="track-db") if db else None
+        )
+        self._db_queries: dict[str, str] = {}
+        self._db_streams: dict[str, StreamEntry] = {}
+        self._db_flush_task: Optional[asyncio.Task] = None
+        self._db_writes = 0
+
+    def lookup(self, query: str) -> tuple[Optional[str], Optional[StreamEntry]]:
+        key = normalize_query(query)
+        vid = self.queries.get(key)
+        if vid is None:
+            return None, None
+        self.queries.move_to_end(key)
+        entry = self.streams.get(vid)
+        if entry is not None:
+            self.streams.move_to_end(vid)
+        return vid, entry
+
+    def get(self, video_id: str) -> Optional[StreamEntry]:
+        entry = self.streams.get(video_id)
+        if entry is not None:
+            self.streams.move_to_end(video_id)
+        return entry
+
+    def _put(self, key: Optional[str], vid: str, entry: StreamEntry):
+        self.streams[vid] = entry
+        self.streams.move_to_end(vid)
+        while len(self.streams) > self.max_streams:
+            self.streams.popitem(last=False)
+        if key:
+            self.queries[key] = vid
+            self.queries.move_to_end(key)
+            while len(self.queries) > self.max_queries:
+                self.queries.popitem(last=False)
+        self.dirty = True
+
+    def store(self, query: Optional[str], info: dict) -> Optional[StreamEntry]:
+        vid = info.get("id")
+        url = info.get("url")
+        if not vid or not url:
+            return None
+        entry = StreamEntry(
+            video_id=vid,
+            url=url,
+            expires_at=stream_url_expiry(url),
+            title=info.get("title") or vid,
+            webpage_url=info.get("webpage_url"),
+            duration=info.get("duration"),
+            acodec=info.get("acodec"),
+        )
+        key = normalize_query(query) if query else None
+        self._put(key, vid, entry)
+        if self.db:
+            self._db_streams[vid] = entry
+            if key:
+                self._db_queries[key] = vid
+            if self._db_flush_task is None or self._db_flush_task.done():
+                self._db_flush_task = asyncio.create_task(self._db_flush_later())
+        return entry
+
+    async def fetch(self, query: Optional[str] = None, video_id: Optional[str] = None
+                    ) -> tuple[Optional[str], Optional[StreamEntry]]:
+        """`lookup`/`get`, falling back to the shared db when the local entry is missing or stale."""
+        if query is not None:
+            vid, entry = self.lookup(query)
+        else:
+            vid, entry = video_id, (self.get(video_id) if video_id else None)
+        if not self.db or (entry is not None and entry.fresh()):
+            return vid, entry
+        key = normalize_query(query) if query is not None else None
+        try:
+            found = await asyncio.get_running_loop().run_in_executor(self._db_executor, self._db_read, key, vid)
+        except Exception as e:
+            print("Shared track cache read failed:", e)
+            return vid, entry
+        if found is None:
+            return vid, entry
+        shared = StreamEntry(**found)
+        if entry is None or shared.expires_at > entry.expires_at:
+            self.shared_hits += 1
+            self._put(key, shared.video_id, shared)
+            return shared.video_id, shared
+        return vid, entry
+
+    def _db(self) -> sqlite3.Connection:
+        if self._db_conn is None:
+            conn = sqlite3.connect(self.db, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # it's a cache: losing the last batch is harmless
+            conn.execute("CREATE TABLE IF NOT EXISTS track_queries "
+                         "(key TEXT PRIMARY KEY, video_id TEXT NOT NULL, saved_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS track_streams "
+                         "(video_id TEXT PRIMARY KEY, data TEXT NOT NULL, saved_at REAL NOT NULL)")
+            self._db_conn = conn
+        return self._db_conn
+
+    def _db_read(self, key: Optional[str], vid: Optional[str]) -> Optional[dict]:
+        conn = self._db()
+        if key is not None and vid is None:
+            row = conn.execute("SELECT video_id FROM track_queries WHERE key = ?", (key,)).fetchone()
+            vid = row[0] if row else None
+        if vid is None:
+            return None
+        row = conn.execute("SELECT data FROM track_streams WHERE video_id = ?", (vid,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _db_write(self, queries: list[tuple], streams: list[tuple]):
+        conn = self._db()
+        now = time.time()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO track_queries (key, video_id, saved_at) VALUES (?, ?, ?)",
+                             [q + (now,) for q in queries])
+            conn.executemany("INSERT OR REPLACE INTO track_streams (video_id, data, saved_at) VALUES (?, ?, ?)",
+                             [st + (now,) for st in streams])
+            self._db_writes += 1
+            if self._db_writes % 100 == 1:
+                cutoff = now - TRACK_CACHE_DB_MAX_AGE
+                conn.execute("DELETE FROM track_queries WHERE saved_at < ?", (cutoff,))
+                conn.execute("DELETE FROM track_streams WHERE saved_at < ?", (cutoff,))
+
+    async def _db_flush_later(self):
+        await asyncio.sleep(TRACK_CACHE_DB_DELAY)
+        queries, self._db_queries = list(self._db_queries.items()), {}
+        streams = [(vid, json.dumps(e.__dict__)) for vid, e in self._db_streams.items()]
+        self._db_streams = {}
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._db_executor, self._db_write, queries, streams)
+        except Exception as e:
+            print("Shared track cache write failed:", e)  # it's only a cache; the entries stay local
+
+    def load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            for key, vid in data.get("queries", []):
+                self.queries[key] = vid
+            for vid, e in data.get("streams", []):
+                self.streams[vid] = StreamEntry(**e)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print("Track cache load failed:", e)
+
+    def _dump(self) -> dict:
+        return {
+            "queries": list(self.queries.items()),
+            "streams": [(vid, e.__dict__) for vid, e in self.streams.items()],
+        }
+
+    async def save(self):
+        if not self.path or not self.dirty:
+            return
+        data = self._dump()  # snapshot on the loop, write off it
+        self.dirty = False
+        def write():
+            # a temp name of our own: launcher.py processes all save to the same path
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                raise
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write)
+        except Exception as e:
+            self.dirty = True
+            print("Track cache save failed:", e)
+
+track_cache = TrackCache(TRACK_CACHE_QUERIES, TRACK_CACHE_STREAMS, TRACK_CACHE_PATH, TRACK_CACHE_DB)
+track_cache.load()
+
+@tasks.loop(minutes=5)
+async def track_cache_flush():
+    await track_cache.save()
+
+# ===== Track search index =====
+def _trigrams(text: str) -> set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TrackIndex:
+    """Autocomplete index of tracks the bot has queued.
+
+    Titles are split into trigrams with an inverted index (trigram -> video ids), so a
+    partial or slightly misspelled query finds candidates without scanning every title.
+    Each guild also remembers its recently queued tracks with play counts; those rank
+    first and the global index fills the rest.
+    """
+    def __init__(self, max_tracks: int, per_guild: int):
+        self.max_tracks = max_tracks
+        self.per_guild = per_guild
+        self.tracks: "OrderedDict[str, tuple[str, str]]" = OrderedDict()  # video id -> (title, webpage_url)
+        self.urls: dict[str, str] = {}  # webpage_url -> video id
+        self.postings: dict[str, set[str]] = {}
+        self.guilds: dict[int, "OrderedDict[str, int]"] = {}  # gid -> video id -> times queued
+
+    def add(self, title: str, webpage_url: Optional[str], video_id: Optional[str], gid: Optional[int] = None):
+        if not video_id or not webpage_url:
+            return
+        if video_id in self.tracks:
+            self.tracks.move_to_end(video_id)
+        else:
+            self.tracks[video_id] = (title, webpage_url)
+            self.urls[webpage_url] = video_id
+            for gram in _trigrams(normalize_query(title)):
+                self.postings.setdefault(gram, set()).add(video_id)
+            while len(self.tracks) > self.max_tracks:
+                self._evict()
+        if gid is not None:
+            plays = self.guilds.setdefault(gid, OrderedDict())
+            plays[video_id] = plays.pop(video_id, 0) + 1
+            while len(plays) > self.per_guild:
+                plays.popitem(last=False)
+
+    def _evict(self):
+        video_id, (title, webpage_url) = self.tracks.popitem(last=False)
+        if self.urls.get(webpage_url) == video_id:
+            del self.urls[webpage_url]
+        for gram in _trigrams(normalize_query(title)):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(video_id)
+                if not ids:
+                    del self.postings[gram]
+
+    def video_id_for(self, webpage_url: str) -> Optional[str]:
+        return self.urls.get(webpage_url)
+
+    def search(self, query: str, gid: int, limit: int = 25) -> list[tuple[str, str, str]]:
+        """Best (video id, title, webpage_url) matches for `query`, this guild's first."""
+        raw = query.strip()
+        if raw in self.tracks:
+            return [(raw, *self.tracks[raw])]  # typed a video id; ids are case-sensitive
+        q = normalize_query(query)
+        plays = self.guilds.get(gid, {})
+        if not q:
+            recent = [v for v in reversed(plays) if v in self.tracks][:limit]
+            return [(v, *self.tracks[v]) for v in recent]
+        grams = _trigrams(q)
+        hits: Counter[str] = Counter()
+        for gram in grams:
+            hits.update(self.postings.get(gram, ()))
+        need = max(1, len(grams) // 2)  # at least half the query's trigrams must match
+
+        def score(v: str) -> float:
+            s = hits[v] / len(grams) + (1.0 if q in normalize_query(self.tracks[v][0]) else 0.0)
+            if v in plays:  # this guild's own tracks win close calls, more so the more they're queued
+                s += 0.3 + 0.05 * min(plays[v], 10)
+            return s
+
+        ranked = sorted((v for v, n in hits.items() if n >= need), key=score, reverse=True)
+        return [(v, *self.tracks[v]) for v in ranked[:limit]]
+
+track_index = TrackIndex(TRACK_INDEX_SIZE, TRACK_INDEX_PER_GUILD)
+for _entry in list(track_cache.streams.values()):  # titles we already know from the saved cache
+    track_index.add(_entry.title, _entry.webpage_url, _entry.video_id)
+
+# ===== Spotify client =====
+class SpotifyClient:
+    """Small async Spotify Web API client (client-credentials flow).
+
+    Responses are kept in an LRU together with their ETag; playlists are revalidated with
+    If-None-Match on every use, so an unchanged playlist costs a 304 instead of a full body.
+    """
+    def __init__(self, client_id: str, client_secret: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self._token: Optional[str] = None
+        self._token_expires = 0.0
+        self._token_lock = asyncio.Lock()
+        self._sem = asyncio.Semaphore(max(1, SPOTIFY_PAGE_CONCURRENCY))
+        self._cache: "OrderedDict[str, tuple[Optional[str], float, dict]]" = OrderedDict()
+        self.requests = 0
+        self.cache_hits = 0
+        self.revalidated = 0
+        self.rate_limited = 0
+
+    def _http(self) -> aiohttp.ClientSession:
+        return http_session()
+
+    async def _auth_headers(self) -> dict:
+        async with self._token_lock:
+            if not self._token or time.time() > self._token_expires - 60:
+                auth = aiohttp.BasicAuth(self.client_id, self.client_secret)
+                async with self._http().post(SPOTIFY_TOKEN_URL, data={"grant_type": "client_credentials"}, auth=auth) as resp:
+                    resp.raise_for_status()
+                    body = await resp.json()
+                self._token = body["access_token"]
+                self._token_expires = time.time() + int(body.get("expires_in", 3600))
+        return {"Authorization": f"Bearer {self._token}"}
+
+    async def get(self, path: str, params: Optional[dict] = None, max_age: float = 0) -> dict:
+        url = path if path.startswith("http") else f"{SPOTIFY_API}{path}"
+        key = f"{url}?{urlencode(sorted(params.items()))}" if params else url
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            if max_age and time.time() - cached[1] < max_age:
+                self.cache_hits += 1
+                return cached[2]
+        async with self._sem:
+            for _ in range(4):
+                headers = await self._auth_headers()
+                if cached is not None and cached[0]:
+                    headers["If-None-Match"] = cached[0]
+                self.requests += 1
+                async with self._http().get(url, params=params, headers=headers) as resp:
+                    if resp.status == 304 and cached is not None:
+                        self.revalidated += 1
+                        self._cache[key] = (cached[0], time.time(), cached[2])
+                        return cached[2]
+                    if resp.status == 429:
+                        self.rate_limited += 1
+                        await asyncio.sleep(min(float(resp.headers.get("Retry-After", "1")), 30))
+                        continue
+                    if resp.status == 401:
+                        self._token = None
+                        continue
+                    resp.raise_for_status()
+                    body = await resp.json()
+                    self._cache[key] = (resp.headers.get("ETag"), time.time(), body)
+                    while len(self._cache) > SPOTIFY_META_CACHE:
+                        self._cache.popitem(last=False)
+                    return body
+        raise RuntimeError(f"Spotify request kept failing: {url}")
+
+    async def get_all_items(self, path: str, page_size: int, params: Optional[dict] = None, max_age: float = 0) -> list:
+        """Fetch every page of a paged endpoint: the first page, then the rest concurrently."""
+        params = dict(params or {}, limit=page_size, offset=0)
+        first = await self.get(path, params, max_age=max_age)
+        items = list(first.get("items") or [])
+        total = first.get("total")
+        if total is None:
+            # No total to plan with: fall back to following `next` links one by one.
+            nxt = first.get("next")
+            while nxt:
+                page = await self.get(nxt, max_age=max_age)
+                items.extend(page.get("items") or [])
+                nxt = page.get("next")
+            return items
+        offsets = range(page_size, total, page_size)
+        pages = await asyncio.gather(*(self.get(path, dict(params, offset=o), max_age=max_age) for o in offsets))
+        for page in pages:
+            items.extend(page.get("items") or [])
+        return items
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "cache_hits": self.cache_hits,
+                "revalidated": self.revalidated, "cached": len(self._cache)}
+
+def _spotify_query(t: dict) -> str:
+    artists = ", ".join(a["name"] for a in t["artists"])
+    return f"{artists} - {t['name']} audio"
+
 # ===== Music player implementation =====
+async def make_audio_source(url: str, acodec: Optional[str] = None, start: float = 0.0) -> discord.AudioSource:
+    """Build the FFmpeg source for `url` according to PLAYBACK_MODE.
+
+    In opus mode an Opus stream is copied straight through (no decode, no re-encode);
+    anything else is encoded to Opus by FFmpeg. With no codec hint we let ffprobe decide.
+    `start` seeks that many seconds into the track (input-side, so nothing before it is fetched).
+    `url` may also be a local file from the audio cache, which needs no reconnect options.
+    """
+    before = FFMPEG_OPTS["before_options"] if url.startswith(("http://", "https://")) else ""
+    if start > 0:
+        before = f"-ss {start:.2f} {before}".strip()
+    opts = {**FFMPEG_OPTS, "before_options": before}
+    if PLAYBACK_MODE == "pcm":
+        return discord.FFmpegPCMAudio(url, **opts)
+    if acodec and acodec != "none":
+        codec = "copy" if acodec.lower().startswith("opus") else None
+        return discord.FFmpegOpusAudio(url, codec=codec, **opts)
+    return await discord.FFmpegOpusAudio.from_probe(url, **opts)
+
+track_gaps = LatencyStats()  # silence between consecutive queued tracks, all guilds
+ffmpeg_start = LatencyStats()  # time to build an FFmpeg source (probe included), all guilds
+
 @dataclass
 class Track:
     title: str
     url: str  # direct audio URL for FFmpeg
     webpage_url: Optional[str] = None
     requested_by: Optional[str] = None
+    video_id: Optional[str] = None
+    expires_at: Optional[float] = None  # when `url` stops working (unix ts)
+    duration: Optional[float] = None
+    acodec: Optional[str] = None  # audio codec reported by yt-dlp, e.g. "opus"
+    start_offset: float = 0.0  # seconds to seek into the track when it starts (restored sessions)
+
+    @classmethod
+    def from_entry(cls, entry: StreamEntry) -> "Track":
+        return cls(title=entry.title, url=entry.url, webpage_url=entry.webpage_url, video_id=entry.video_id,
+                   expires_at=entry.expires_at, duration=entry.duration, acodec=entry.acodec)
+
+    def to_snapshot(self) -> dict:
+        # no stream URL: it's signed and short-lived, the page/video id is what survives a restart
+        return {"title": self.title, "webpage_url": self.webpage_url, "requested_by": self.requested_by,
+                "video_id": self.video_id, "duration": self.duration}
+
+    @classmethod
+    def from_snapshot(cls, d: dict, start_offset: float = 0.0) -> "Track":
+        # expires_at=0 makes refresh_track resolve the stream URL when the track comes up
+        return cls(title=d["title"], url="", webpage_url=d.get("webpage_url"), requested_by=d.get("requested_by"),
+                   video_id=d.get("video_id"), expires_at=0.0, duration=d.get("duration"), start_offset=start_offset)
+
+_VIDEO_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")  # safe to use as a file name
+
+class AudioFileCache:
+    """Byte-budgeted LRU directory of Opus files for tracks that keep getting played.
+
+    Once a track has been played AUDIO_CACHE_MIN_PLAYS times, a background FFmpeg copies
+    its stream (no re-encode when the source is Opus already) into `<video id>.opus`, and
+    player_loop plays that file from then on instead of streaming the track again. Files
+    are written under a temp name and renamed, so a half-written file is never played.
+    The index and byte budget are per process; launcher.py processes each get their own
+    `group<N>` subdirectory.
+    """
+    def __init__(self, directory: Optional[str], max_bytes: int, min_plays: int):
+        self.dir = Path(directory) if directory else None
+        self.max_bytes = max_bytes
+        self.min_plays = max(1, min_plays)
+        self.files: "OrderedDict[str, int]" = OrderedDict()  # video id -> size, oldest first
+        self.bytes = 0
+        self.plays: Counter[str] = Counter()
+        self._jobs: dict[str, asyncio.Task] = {}
+        self._sem: Optional[asyncio.Semaphore] = None  # created on the loop
+        self.hits = 0
+        self.streamed = 0
+        self.stored = 0
+        self.failures = 0
+        if self.dir is not None:
+            self._scan()
+
+    def _scan(self):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        found = []
+        stale = time.time() - AUDIO_CACHE_TIMEOUT
+        for e in os.scandir(self.dir):
+            if e.name.endswith(".part"):
+                if e.stat().st_mtime < stale:
+                    self._unlink([Path(e.path)])  # interrupted download; newer ones may still be running
+            elif e.name.endswith(".opus") and e.is_file():
+                st = e.stat()
+                found.append((st.st_mtime, e.name[:-len(".opus")], st.st_size))
+        for _, vid, size in sorted(found):
+            self.files[vid] = size
+            self.bytes += size
+        self._unlink(self._victims())
+
+    def _path(self, video_id: str) -> Path:
+        return self.dir / f"{video_id}.opus"
+
+    def path_for(self, video_id: Optional[str]) -> Optional[str]:
+        """Local file for `video_id`, if cached (and still on disk)."""
+        if self.dir is None or not video_id or video_id not in self.files:
+            return None
+        path = self._path(video_id)
+        if not path.exists():  # removed behind our back; stream it instead
+            self.bytes -= self.files.pop(video_id)
+            return None
+        self.files.move_to_end(video_id)
+        return str(path)
+
+    def note_play(self, track: Track):
+        """Count a play of `track`; start caching it once it's popular enough."""
+        vid = track.video_id
+        if self.dir is None:
+            return
+        if vid in self.files:
+            self.hits += 1
+            try:
+                os.utime(self._path(vid))  # keeps LRU order across restarts
+            except OSError:
+                pass
+            return
+        self.streamed += 1
+        if not vid or not _VIDEO_ID_RE.match(vid):
+            return
+        self.plays[vid] += 1
+        if len(self.plays) > AUDIO_CACHE_TRACKED:
+            self.plays = Counter(dict(self.plays.most_common(AUDIO_CACHE_TRACKED // 2)))
+        if self.plays[vid] >= self.min_plays and vid not in self._jobs and track.url.startswith("http"):
+            self._jobs[vid] = asyncio.create_task(self._fetch(vid, track.url, track.acodec))
+
+    async def _fetch(self, vid: str, url: str, acodec: Optional[str]):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(AUDIO_CACHE_JOBS)
+        fd, part_name = tempfile.mkstemp(dir=self.dir, prefix=f"{vid}.", suffix=".part")
+        os.close(fd)
+        part = Path(part_name)
+        if acodec and acodec.lower().startswith("opus"):
+            codec = ["-c:a", "copy"]
+        else:
+            codec = ["-c:a", "libopus", "-b:a", "128k"]
+        try:
+            async with self._sem:
+                proc = await asyncio.create_subprocess_exec(
+                    "ffmpeg", "-nostdin", "-loglevel", "error", "-y", *FFMPEG_OPTS["before_options"].split(),
+                    "-i", url, "-vn", *codec, "-f", "opus", str(part),
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                try:
+                    _, err = await asyncio.wait_for(proc.communicate(), timeout=AUDIO_CACHE_TIMEOUT)
+                except BaseException:
+                    proc.kill()
+                    await proc.wait()
+                    raise
+            if proc.returncode != 0:
+                raise RuntimeError(err.decode(errors="replace").strip()[-300:] or f"ffmpeg exited with {proc.returncode}")
+            size = part.stat().st_size
+            os.replace(part, self._path(vid))
+            self.files[vid] = size
+            self.bytes += size
+            self.stored += 1
+            self.plays.pop(vid, None)
+            victims = self._victims()
+            if victims:
+                await asyncio.get_running_loop().run_in_executor(None, self._unlink, victims)
+        except asyncio.CancelledError:
+            self._unlink([part])
+            raise
+        except Exception as e:
+            self.failures += 1
+            log_error("audio_cache", e)
+            self._unlink([part])
+        finally:
+            self._jobs.pop(vid, None)
+
+    def _victims(self) -> list[Path]:
+        out = []
+        while self.bytes > self.max_bytes and self.files:
+            vid, size = self.files.popitem(last=False)
+            self.bytes -= size
+            out.append(self._path(vid))
+        return out
+
+    @staticmethod
+    def _unlink(paths: list[Path]):
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+audio_cache = AudioFileCache(
+    os.path.join(AUDIO_CACHE_DIR, f"group{SHARD_GROUP}") if AUDIO_CACHE_DIR and SHARD_IDS is not None else AUDIO_CACHE_DIR,
+    AUDIO_CACHE_BYTES, AUDIO_CACHE_MIN_PLAYS,
+)
+
+class TrackQueue:
+    """Per-guild track queue: a list with a moving head.
+
+    Append and pop-from-front are O(1) (the consumed prefix is trimmed in bulk), indexed
+    access and slices are O(1)/O(k), so /queue pages never copy the whole queue.
+    `version` changes on every mutation (unique across queues), so snapshots can tell
+    whether a queue needs rewriting.
+    """
+    _versions = itertools.count(1)
+
+    def __init__(self, maxsize: int = 0):
+        self.maxsize = maxsize
+        self._items: List[Optional[Track]] = []
+        self._head = 0
+        self._nonempty = asyncio.Event()
+        self.version = next(self._versions)
+
+    def _touch(self):
+        self.version = next(self._versions)
+
+    def __len__(self) -> int:
+        return len(self._items) - self._head
+
+    def __iter__(self):
+        return itertools.islice(self._items, self._head, None)
+
+    def __getitem__(self, index: int) -> Track:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._items[self._head + index]
+
+    def qsize(self) -> int:
+        return len(self)
+
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    def full(self) -> bool:
+        return self.maxsize > 0 and len(self) >= self.maxsize
+
+    def slice(self, start: int, stop: int) -> List[Track]:
+        start, stop = max(0, start), max(0, stop)
+        return self._items[self._head + start:self._head + stop]
+
+    def put_nowait(self, track: Track) -> bool:
+        if self.full():
+            return False
+        self._items.append(track)
+        self._touch()
+        self._nonempty.set()
+        return True
+
+    def get_nowait(self) -> Track:
+        if self.empty():
+            raise asyncio.QueueEmpty
+        track = self._items[self._head]
+        self._items[self._head] = None
+        self._head += 1
+        self._touch()
+        if self._head >= 64 and self._head * 2 >= len(self._items):
+            del self._items[:self._head]
+            self._head = 0
+        return track
+
+    async def get(self) -> Track:
+        while self.empty():
+            self._nonempty.clear()
+            await self._nonempty.wait()
+        return self.get_nowait()
+
+    def remove(self, index: int) -> Track:
+        track = self[index]
+        del self._items[self._head + index]
+        self._touch()
+        return track
+
+    def move(self, src: int, dst: int) -> Track:
+        track = self.remove(src)
+        self._items.insert(self._head + max(0, min(dst, len(self))), track)
+        self._touch()
+        return track
+
+    def shuffle(self):
+        rest = self._items[self._head:]
+        random.shuffle(rest)
+        self._items, self._head = rest, 0
+        self._touch()
+
+    def dedupe(self) -> int:
+        seen: set[str] = set()
+        kept = []
+        for t in self:
+            key = t.video_id or t.webpage_url or t.url
+            if key not in seen:
+                seen.add(key)
+                kept.append(t)
+        removed = len(self) - len(kept)
+        self._items, self._head = kept, 0
+        self._touch()
+        return removed
+
+    def clear(self) -> int:
+        n = len(self)
+        self._items, self._head = [], 0
+        self._touch()
+        return n
 
 class GuildPlayer:
     def __init__(self, guild_id: int):
         self.guild_id = guild_id
-        self.queue: asyncio.Queue[Track] = asyncio.Queue()
+        self.queue = TrackQueue(QUEUE_MAX_TRACKS)
         self.play_task: Optional[asyncio.Task] = None
         self.voice: Optional[discord.VoiceClient] = None
         self.current: Optional[Track] = None
         self.stop_signal = asyncio.Event()
+        self.track_started = 0.0  # monotonic time the current track started (0 until it does)
+        self._ended_at: Optional[float] = None  # set by `after` when another track is waiting
+        self._prefetch_task: Optional[asyncio.Task] = None
+        self._warm: Optional[tuple[Track, str, discord.AudioSource]] = None
+        self.sfx_done: Optional[asyncio.Future] = None  # reminder clip currently playing, if any
+        self.last_active = time.monotonic()
+        self._empty_timer: Optional[asyncio.Task] = None
 
     async def ensure_player_task(self, guild: discord.Guild):
+        self.last_active = time.monotonic()
         if self.play_task is None or self.play_task.done():
+            self.stop_signal.clear()  # a player stopped by /leave can be reused
             self.play_task = asyncio.create_task(self.player_loop(guild))
 
+    async def enqueue(self, track: Track) -> bool:
+        """Add `track`; False if the queue is at QUEUE_MAX_TRACKS."""
+        self.last_active = time.monotonic()
+        if not self.queue.put_nowait(track):
+            return False
+        track_index.add(track.title, track.webpage_url, track.video_id, self.guild_id)
+        self.kick_prefetch()
+        return True
+
+    def upcoming(self, n: int) -> List[Track]:
+        return self.queue.slice(0, n)
+
+    def kick_prefetch(self):
+        """(Re)start the prefetch stage for whatever is next in the queue."""
+        if PREFETCH_DEPTH <= 0 or self.current is None:
+            return  # nothing playing: player_loop will take the next track straight away
+        if self._prefetch_task and not self._prefetch_task.done():
+            self._prefetch_task.cancel()
+        self._prefetch_task = asyncio.create_task(self._prefetch(self.current))
+
+    async def _playable(self, track: Track) -> Optional[tuple[str, Optional[str]]]:
+        """(input, codec) for `track`: its file in the audio cache, else a fresh stream URL."""
+        local = audio_cache.path_for(track.video_id)
+        if local is not None:
+            return local, "opus"
+        if not await refresh_track(track, self.guild_id):
+            return None
+        return track.url, track.acodec
+
+    def _warm_for(self, track: Track) -> bool:
+        # a warm local file never goes stale; a warm stream must still be the track's URL
+        return bool(self._warm and self._warm[0] is track
+                    and (self._warm[1] == track.url or not self._warm[1].startswith("http")))
+
+    async def _prefetch(self, playing: Track):
+        for tr in self.upcoming(PREFETCH_DEPTH):
+            if audio_cache.path_for(tr.video_id) is None:
+                await refresh_track(tr, self.guild_id)
+        if playing.duration:
+            wait = self.track_started + playing.duration - PREFETCH_WARM_LEAD - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        nxt = next(iter(self.upcoming(1)), None)
+        if self.current is not playing or nxt is None:
+            return
+        if self._warm_for(nxt):
+            return
+        playable = await self._playable(nxt)
+        if playable is None:
+            return
+        url, acodec = playable
+        started = time.monotonic()
+        source = await make_audio_source(url, acodec, nxt.start_offset)
+        ffmpeg_start.observe(time.monotonic() - started)
+        if self.current is not playing or next(iter(self.upcoming(1)), None) is not nxt:
+            source.cleanup()
+            return
+        self._drop_warm()
+        self._warm = (nxt, url, source)
+
+    def _take_warm(self, track: Track) -> Optional[discord.AudioSource]:
+        if self._warm_for(track):
+            source = self._warm[2]
+            self._warm = None
+            return source
+        self._drop_warm()
+        return None
+
+    def _drop_warm(self):
+        if self._warm:
+            try:
+                self._warm[2].cleanup()
+            except Exception:
+                pass
+            self._warm = None
+
+    def _discard_current(self):
+        """Drop a popped track that won't play; whatever plays next doesn't follow a gap."""
+        self.current = None
+        self._ended_at = None
+
     async def player_loop(self, guild: discord.Guild):
-        while not self.stop_signal.is_set():
+        while not self.stop_signal.is_set() and not shutting_down:
             self.current = await self.queue.get()
+            self.track_started = 0.0
             if self.voice is None or not self.voice.is_connected():
-                self.current = None
+                self._drop_warm()
+                self._discard_current()
                 continue
-            source = discord.FFmpegPCMAudio(self.current.url, **FFMPEG_OPTS)
+            playable = await self._playable(self.current)
+            if playable is None:
+                self._discard_current()
+                continue
+            source = self._take_warm(self.current)
+            if source is None:
+                started = time.monotonic()
+                try:
+                    source = await make_audio_source(*playable, self.current.start_offset)
+                except Exception as e:
+                    log_error("ffmpeg_start", e)
+                    self._discard_current()
+                    continue
+                ffmpeg_start.observe(time.monotonic() - started)
+            if self.sfx_done is not None and not self.sfx_done.done():
+                await self.sfx_done
+            loop = asyncio.get_running_loop()
+            finished = loop.create_future()
             def after_play(err):
-                guild._state.loop.call_soon_threadsafe(self.queue.task_done)
-            self.voice.play(source, after=after_play)
-            while self.voice.is_playing() or self.voice.is_paused():
-                await asyncio.sleep(0.5)
+                # a stop()/disconnect also lands here; that isn't the start of a gap
+                waiting = not self.queue.empty() and not self.stop_signal.is_set()
+                self._ended_at = time.monotonic() if waiting else None
+                loop.call_soon_threadsafe(_resolve_future, finished, err)
+            try:
+                self.voice.play(source, after=after_play)
+            except discord.ClientException:  # disconnected (or busy) under us
+                source.cleanup()
+                self._discard_current()
+                continue
+            self.track_started = time.monotonic()
+            audio_cache.note_play(self.current)
+            if self._ended_at is not None:
+                gap = self.track_started - self._ended_at
+                track_gaps.observe(gap)
+                self._ended_at = None
+            self.kick_prefetch()
+            await finished  # `after` fires on track end, skip, stop or disconnect
             self.current = None
+            self.last_active = time.monotonic()
 
     def skip(self):
         if self.voice and self.voice.is_playing():
@@ -241,13 +2018,223 @@ class GuildPlayer:
 
     def stop(self):
         self.stop_signal.set()
+        current = asyncio.current_task()
+        for task in (self.play_task, self._prefetch_task, self._empty_timer):
+            if task and task is not current and not task.done():
+                task.cancel()
+        self._empty_timer = None
+        self._drop_warm()
+        self.current = None
+        self._ended_at = None  # time away before a later /join isn't an inter-track gap
         if self.voice and self.voice.is_connected():
             try:
                 asyncio.create_task(self.voice.disconnect(force=True))
             except Exception:
                 pass
 
+    def snapshot(self) -> Optional[tuple[int, Optional[Track], float]]:
+        """(voice channel id, current track, seconds into it), or None if there's nothing to restore."""
+        channel = self.voice.channel if self.voice else None
+        if self.stop_signal.is_set() or channel is None or (self.current is None and self.queue.empty()):
+            return None
+        position = 0.0
+        if self.current is not None:
+            position = self.current.start_offset
+            if self.track_started:
+                position += time.monotonic() - self.track_started
+        return channel.id, self.current, position
+
+    def is_idle(self) -> bool:
+        return self.current is None and self.queue.empty() and not (self.voice and self.voice.is_playing())
+
+    def teardown(self):
+        """Stop everything this player owns and forget it."""
+        self.stop()
+        if players.get(self.guild_id) is self:
+            del players[self.guild_id]
+
+    def watch_channel(self):
+        """Start or cancel the empty-channel countdown for the bot's current voice channel."""
+        channel = self.voice.channel if self.voice and self.voice.is_connected() else None
+        empty = channel is not None and not any(not m.bot for m in channel.members)
+        if empty and VOICE_EMPTY_TIMEOUT > 0:
+            if self._empty_timer is None or self._empty_timer.done():
+                self._empty_timer = asyncio.create_task(self._leave_when_empty())
+        elif self._empty_timer is not None:
+            self._empty_timer.cancel()
+            self._empty_timer = None
+
+    async def _leave_when_empty(self):
+        await asyncio.sleep(VOICE_EMPTY_TIMEOUT)
+        self._empty_timer = None
+        self.teardown()
+
 players: dict[int, GuildPlayer] = {}
+shutting_down = False  # set by close(); player loops stop taking tracks so the final snapshot keeps them
+
+@tasks.loop(seconds=PLAYER_REAP_INTERVAL)
+async def reap_players():
+    """Tear down players that have sat idle past PLAYER_IDLE_TIMEOUT.
+
+    A player parked in voice is kept while its guild has interval reminders (those only
+    run while the bot is in voice) or daily reminders with sound on (the beep needs the
+    bot in voice); an empty channel is still left via VOICE_EMPTY_TIMEOUT.
+    """
+    now = time.monotonic()
+    for gid, gp in list(players.items()):
+        if not gp.is_idle() or now - gp.last_active < PLAYER_IDLE_TIMEOUT:
+            continue
+        cfg = smoke_cfg.get(gid)
+        if gp.voice and gp.voice.is_connected() and cfg and (cfg.interval_minutes or (cfg.sound and cfg.times)):
+            continue
+        gp.teardown()
+
+def player_stats() -> dict:
+    return {
+        "players": len(players),
+        "connected": sum(1 for gp in players.values() if gp.voice and gp.voice.is_connected()),
+        "playing": sum(1 for gp in players.values() if gp.current is not None),
+        "queued": sum(len(gp.queue) for gp in players.values()),
+        "tasks": len(asyncio.all_tasks()),
+    }
+
+class PlayerSnapshotStore:
+    """Per-guild queue snapshots, kept in the `players` table of the smoke SQLite file.
+
+    Only what's needed to rebuild a queue is stored (titles, pages, video ids), never the
+    signed stream URLs, which have expired by the time they're read back. A guild's queue
+    column is only rewritten when its queue changed since the last snapshot; otherwise a
+    snapshot just moves the current track's position forward. Reads and writes go through
+    the SmokeStore's writer thread and connection, so the file has a single writer.
+    """
+    def __init__(self, store: SmokeStore):
+        self.store = store
+        self._table_ready = False
+        self._saved: dict[int, int] = {}  # gid -> queue version in the last successful write
+        self.save_time = LatencyStats()
+        self.failures = 0
+
+    def _db(self) -> sqlite3.Connection:
+        """The store's connection, with the players table in place; call on its executor."""
+        if self.store._conn is None:
+            self.store._conn = self.store._connect()
+        if not self._table_ready:
+            self.store._conn.execute(
+                "CREATE TABLE IF NOT EXISTS players (gid INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, "
+                "current TEXT, position REAL NOT NULL, queue TEXT NOT NULL, saved_at REAL NOT NULL)"
+            )
+            self._table_ready = True
+        return self.store._conn
+
+    def _read(self) -> list[tuple]:
+        conn = self._db()
+        cutoff = time.time() - PLAYER_SNAPSHOT_MAX_AGE
+        with conn:
+            conn.execute("DELETE FROM players WHERE saved_at < ?", (cutoff,))
+        return conn.execute("SELECT gid, channel_id, current, position, queue FROM players").fetchall()
+
+    async def load(self) -> list[tuple]:
+        return await asyncio.get_running_loop().run_in_executor(self.store._executor, self._read)
+
+    def _rows(self):
+        full, partial, versions, now = [], [], {}, time.time()
+        for gid, gp in players.items():
+            state = gp.snapshot()
+            if state is None:
+                continue
+            channel_id, current, position = state
+            cur = json.dumps(current.to_snapshot()) if current else None
+            versions[gid] = gp.queue.version
+            if self._saved.get(gid) == gp.queue.version:
+                partial.append((channel_id, cur, position, now, gid))
+            else:
+                full.append((gid, channel_id, cur, position, json.dumps([t.to_snapshot() for t in gp.queue]), now))
+        gone = [(gid,) for gid in self._saved if gid not in versions]
+        return full, partial, gone, versions
+
+    def _write(self, full: list[tuple], partial: list[tuple], gone: list[tuple]):
+        conn = self._db()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO players (gid, channel_id, current, position, queue, saved_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)", full
+            )
+            conn.executemany(
+                "UPDATE players SET channel_id = ?, current = ?, position = ?, saved_at = ? WHERE gid = ?", partial
+            )
+            conn.executemany("DELETE FROM players WHERE gid = ?", gone)
+
+    async def save(self):
+        full, partial, gone, versions = self._rows()
+        if not (full or partial or gone):
+            return
+        started = time.monotonic()
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.store._executor, self._write, full, partial, gone)
+            self._saved = versions
+        except Exception as e:
+            self.failures += 1
+            print("Player snapshot failed:", e)
+        finally:
+            self.save_time.observe(time.monotonic() - started)
+
+player_store = PlayerSnapshotStore(smoke_store)
+
+async def _restore_player(gid: int, channel_id: int, current: Optional[str], position: float, queue: str) -> bool:
+    guild = bot.get_guild(gid)
+    channel = guild.get_channel(channel_id) if guild else None
+    if not isinstance(channel, (discord.VoiceChannel, discord.StageChannel)):
+        return False  # not our shard, or the channel is gone
+    gp = get_player(guild)
+    if (gp.voice and gp.voice.is_connected()) or gp.current is not None or not gp.queue.empty():
+        return False  # someone already started a new session
+    tracks = [Track.from_snapshot(d) for d in json.loads(queue)]
+    if current:
+        tracks.insert(0, Track.from_snapshot(json.loads(current), start_offset=position))
+    try:
+        gp.voice = await channel.connect(self_deaf=True)
+    except Exception as e:
+        print(f"Rejoining voice for guild {gid} failed:", e)
+        return False
+    for tr in tracks:
+        gp.queue.put_nowait(tr)
+    await gp.ensure_player_task(guild)
+    gp.watch_channel()  # leaves again after VOICE_EMPTY_TIMEOUT if nobody came back
+    return True
+
+async def restore_players():
+    """Rejoin voice and rebuild the queues saved before the last restart.
+
+    Stream URLs are re-resolved lazily as tracks come up (or get prefetched), and the
+    track that was playing resumes at its saved position.
+    """
+    try:
+        rows = await player_store.load()
+    except Exception as e:
+        print("Player snapshot load failed:", e)
+        return
+    sem = asyncio.Semaphore(PLAYER_RESTORE_CONCURRENCY)
+
+    async def one(row) -> bool:
+        async with sem:
+            try:
+                return await _restore_player(*row)
+            except Exception as e:
+                print(f"Restoring player for guild {row[0]} failed:", e)
+                return False
+
+    restored = sum(await asyncio.gather(*(one(row) for row in rows)))
+    if restored:
+        print(f"Restored {restored} player(s) from snapshot")
+
+@tasks.loop(seconds=max(1, PLAYER_SNAPSHOT_INTERVAL))
+async def snapshot_players():
+    await player_store.save()
+
+@snapshot_players.before_loop
+async def _restore_before_snapshots():
+    # restore first: the first snapshot would otherwise delete the rows being restored
+    await restore_players()
 
 def get_player(guild: discord.Guild) -> GuildPlayer:
     gp = players.get(guild.id)
@@ -256,87 +2243,143 @@ def get_player(guild: discord.Guild) -> GuildPlayer:
         players[guild.id] = gp
     return gp
 
-def make_spotify_client() -> Optional[Spotify]:
+def make_spotify_client() -> Optional[SpotifyClient]:
     if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
-        auth = SpotifyClientCredentials(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET
-        )
-        return Spotify(client_credentials_manager=auth)
+        return SpotifyClient(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
     return None
 
-sp_client = make_spotify_client()
+sp_client: Optional[SpotifyClient] = None  # built on the first Spotify link
 
-async def youtube_search_first(query: str) -> Optional[Track]:
-    with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-            if info is None:
-                return None
-            if "entries" in info and info["entries"]:
-                info = info["entries"][0]
-            stream_url = info.get("url") or info.get("webpage_url")
-            if not stream_url:
-                return None
-            title = info.get("title") or query
-            return Track(title=title, url=stream_url, webpage_url=info.get("webpage_url"))
-        except Exception:
-            return None
+def spotify() -> Optional[SpotifyClient]:
+    global sp_client
+    if sp_client is None:
+        sp_client = make_spotify_client()
+    return sp_client
 
-def parse_spotify(url: str) -> List[str]:
+async def youtube_search_first(query: str, guild_id: int = 0) -> Optional[Track]:
+    known = track_index.video_id_for(query)  # an autocomplete pick is the page URL of an indexed track
+    if known is not None:
+        vid, entry = await track_cache.fetch(video_id=known)
+    else:
+        vid, entry = await track_cache.fetch(query=query)
+    if entry is not None and entry.fresh():
+        track_cache.hits += 1
+        return Track.from_entry(entry)
+    track_cache.misses += 1
+    # Known video with an expired URL: re-resolve the page directly, skipping the search.
+    target = entry.webpage_url if entry is not None and entry.webpage_url else query
+    try:
+        info = await resolver.extract(guild_id, target)
+    except Exception as e:
+        log_error("resolve", e)
+        return None
+    if not info:
+        return None
+    entry = track_cache.store(query, info)
+    if entry is not None:
+        return Track.from_entry(entry)
+    stream_url = info.get("url") or info.get("webpage_url")
+    if not stream_url:
+        return None
+    title = info.get("title") or query
+    return Track(title=title, url=stream_url, webpage_url=info.get("webpage_url"))
+
+async def refresh_track(track: Track, guild_id: int = 0) -> bool:
+    """Make sure `track.url` is still valid; re-resolve lazily if it's about to expire."""
+    if track.expires_at is None or track.expires_at - time.time() > STREAM_URL_REFRESH_MARGIN:
+        return True
+    _, entry = await track_cache.fetch(video_id=track.video_id) if track.video_id else (None, None)
+    if entry is None or not entry.fresh():
+        target = (entry.webpage_url if entry else None) or track.webpage_url
+        if not target:
+            return False
+        try:
+            info = await resolver.extract(guild_id, target)
+        except Exception as e:
+            log_error("refresh", e)
+            return False
+        entry = track_cache.store(None, info) if info else None
+        if entry is None:
+            return False
+    track.url = entry.url
+    track.expires_at = entry.expires_at
+    track.acodec = entry.acodec
+    return True
+
+async def parse_spotify(url: str) -> List[str]:
+    sp_client = spotify()
     if not sp_client:
         return []
     try:
         if "/track/" in url:
             tid = url.split("/track/")[1].split("?")[0]
-            t = sp_client.track(tid)
-            artists = ", ".join(a["name"] for a in t["artists"])
-            return [f"{artists} - {t['name']} audio"]
+            t = await sp_client.get(f"/tracks/{tid}", max_age=SPOTIFY_STATIC_MAX_AGE)
+            return [_spotify_query(t)]
         if "/album/" in url:
             aid = url.split("/album/")[1].split("?")[0]
-            album = sp_client.album(aid)
-            out = []
-            for t in album["tracks"]["items"]:
-                artists = ", ".join(a["name"] for a in t["artists"])
-                out.append(f"{artists} - {t['name']} audio")
-            return out
+            items = await sp_client.get_all_items(f"/albums/{aid}/tracks", 50, max_age=SPOTIFY_STATIC_MAX_AGE)
+            return [_spotify_query(t) for t in items if t]
         if "/playlist/" in url:
             pid = url.split("/playlist/")[1].split("?")[0]
-            pl = sp_client.playlist(pid)
-            out = []
-            for it in pl["tracks"]["items"]:
-                t = it["track"]
-                if not t:
-                    continue
-                artists = ", ".join(a["name"] for a in t["artists"])
-                out.append(f"{artists} - {t['name']} audio")
-            return out
-    except Exception:
+            items = await sp_client.get_all_items(
+                f"/playlists/{pid}/tracks", 100,
+                params={"fields": "items(track(name,artists(name))),next,total"},
+            )
+            return [_spotify_query(it["track"]) for it in items if it and it.get("track")]
+    except Exception as e:
+        log_error("spotify", e)
         return []
     return []
 
-async def enqueue_from_input(guild: discord.Guild, query: str, requested_by: str) -> int:
+async def enqueue_from_input(guild: discord.Guild, query: str, requested_by: str, on_progress=None) -> int:
+    """Resolve `query` and put the results on the guild queue.
+
+    Spotify albums/playlists resolve with up to SPOTIFY_RESOLVE_CONCURRENCY lookups in
+    flight, but land on the queue in playlist order; the first track starts playing as
+    soon as it resolves. `on_progress(done, total, added)` is awaited after each lookup.
+    """
     gp = get_player(guild)
     if not SPOTIFY_URL_RE.search(query):
         q = query if query.startswith("http") else f"ytsearch1:{query}"
-        track = await youtube_search_first(q)
+        track = await youtube_search_first(q, guild.id)
         if track:
             track.requested_by = requested_by
-            await gp.queue.put(track)
-            return 1
+            return 1 if await gp.enqueue(track) else 0
         return 0
 
-    queries = parse_spotify(query)
+    queries = await parse_spotify(query)
     if not queries:
         queries = [query]
 
-    added = 0
-    for q in queries:
-        tr = await youtube_search_first(f"ytsearch1:{q}")
-        if tr:
-            tr.requested_by = requested_by
-            await gp.queue.put(tr)
-            added += 1
+    pending = iter(queries)
+    window: deque[asyncio.Task] = deque()
+
+    def fill():
+        while len(window) < max(1, SPOTIFY_RESOLVE_CONCURRENCY):
+            q = next(pending, None)
+            if q is None:
+                return
+            window.append(asyncio.create_task(youtube_search_first(f"ytsearch1:{q}", guild.id)))
+
+    added = done = 0
+    try:
+        fill()
+        while window:
+            tr = await window.popleft()  # awaiting the head keeps playlist order
+            done += 1
+            fill()
+            if tr:
+                tr.requested_by = requested_by
+                if not await gp.enqueue(tr):
+                    break  # queue is full; the finally below cancels the rest
+                added += 1
+                if added == 1:
+                    await gp.ensure_player_task(guild)
+            if on_progress:
+                await on_progress(done, len(queries), added)
+    finally:
+        for task in window:
+            task.cancel()
     return added
 
 # === Smoke Reminder Commands ===
@@ -361,17 +2404,16 @@ async def smoke_start35(inter: discord.Interaction, message: str | None = None,
         await gp.ensure_player_task(inter.guild)
 
     # Configure reminders: 35 minutes, sound on, this text channel (or selected channel)
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
+    cfg = get_smoke_cfg(inter.guild_id)
     ch = channel or inter.channel
-    cfg["channel_id"] = ch.id
-    cfg["interval_minutes"] = 35
-    cfg["interval_last_ts"] = None  # start counting now
+    cfg.channel_id = ch.id
+    cfg.interval_minutes = 35
+    cfg.interval_last_ts = None  # start counting now
     if message:
-        cfg["message"] = message
-    cfg["times"] = []
-    cfg.setdefault("tz", DEFAULT_TZ)
-    cfg["sound"] = True
-    save_smoke()
+        cfg.message = message
+    cfg.times = []
+    cfg.sound = True
+    smoke_changed(inter.guild_id)
 
     await inter.followup.send(f"✅ Joined **{vs.channel.name}** and set smoke reminder every **35 minutes** (sound **on**) posting in {ch.mention}.")
 
@@ -383,17 +2425,15 @@ async def smoke_every(inter: discord.Interaction, minutes: int, message: str | N
         return await inter.followup.send("Server-only command.")
     if minutes < 1 or minutes > 1440:
         return await inter.followup.send("Choose 1–1440 minutes.")
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
+    cfg = get_smoke_cfg(inter.guild_id)
     ch = channel or inter.channel
-    cfg["channel_id"] = ch.id
-    cfg["interval_minutes"] = int(minutes)
-    cfg["interval_last_ts"] = None  # start counting when first seen in voice
+    cfg.channel_id = ch.id
+    cfg.interval_minutes = int(minutes)
+    cfg.interval_last_ts = None  # start counting when first seen in voice
     if message:
-        cfg["message"] = message
-    cfg["times"] = []  # disable fixed-time mode
-    cfg.setdefault("tz", DEFAULT_TZ)
-    cfg.setdefault("sound", True)
-    save_smoke()
+        cfg.message = message
+    cfg.times = []  # disable fixed-time mode
+    smoke_changed(inter.guild_id)
     await inter.followup.send(f"✅ Interval reminders set: every **{minutes}** minutes **while in voice** in {ch.mention}.")
 
 @smoke.command(name="sound", description="Turn the sound reminder on or off.")
@@ -403,9 +2443,9 @@ async def smoke_sound(inter: discord.Interaction, toggle: str):
     t = toggle.lower().strip()
     if t not in ("on", "off"):
         return await inter.followup.send("Use `on` or `off`.")
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["sound"] = (t == "on")
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    cfg.sound = (t == "on")
+    smoke_changed(inter.guild_id)
     await inter.followup.send(f"🔊 Sound reminder: **{t}**.")
 
 @smoke.command(name="soundset", description="Upload a custom sound file to play for reminders.")
@@ -418,22 +2458,22 @@ async def smoke_soundset(inter: discord.Interaction, file: discord.Attachment):
     ext = Path(file.filename).suffix.lower()
     if ext not in {".wav", ".mp3", ".ogg", ".opus", ".m4a", ".webm"}:
         return await inter.followup.send("Unsupported file type. Allowed: .wav, .mp3, .ogg, .opus, .m4a, .webm")
-    # Download to guild-specific path
-    out_path = (ASSETS_DIR / f"smoke_custom_{inter.guild_id}.dat")
+    if file.size > SOUND_MAX_BYTES:
+        return await inter.followup.send(f"File too large (>{SOUND_MAX_BYTES // (1024 * 1024)}MB).")
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(file.url) as resp:
-                if resp.status != 200:
-                    return await inter.followup.send("Could not download the file.")
-                data = await resp.read()
-        out_path.write_bytes(data)
-    except Exception:
+        out_path = await download_sound(file.url)
+    except DownloadError as e:
+        return await inter.followup.send(str(e))
+    except Exception as e:
+        log_error("sound_download", e)
         return await inter.followup.send("Failed to save the file.")
+    reminder_sounds.prewarm(str(out_path))
     # Save into config
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["sound_path"] = str(out_path)
-    cfg.setdefault("sound", True)
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    old_path, cfg.sound_path = cfg.sound_path, str(out_path)
+    if old_path != cfg.sound_path:
+        await release_sound(old_path, inter.guild_id)
+    smoke_changed(inter.guild_id)
     return await inter.followup.send(f"🔊 Custom sound set: `{file.filename}`")
 
 @smoke.command(name="soundurl", description="Use a direct URL for the reminder sound.")
@@ -442,40 +2482,30 @@ async def smoke_soundurl(inter: discord.Interaction, url: str):
     await inter.response.defer(ephemeral=True, thinking=True)
     if not inter.guild:
         return await inter.followup.send("Server-only command.")
-    # Fetch and store under guild path (let FFmpeg probe format)
-    out_path = (ASSETS_DIR / f"smoke_custom_{inter.guild_id}.dat")
+    # Fetch and store content-addressed (let FFmpeg probe format)
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as resp:
-                if resp.status != 200:
-                    return await inter.followup.send("Could not download the URL (non-200).")
-                # Simple size guard (~15 MB)
-                size = int(resp.headers.get("Content-Length") or 0)
-                if size and size > 15 * 1024 * 1024:
-                    return await inter.followup.send("File too large (>15MB).")
-                data = await resp.read()
-        out_path.write_bytes(data)
-    except Exception:
+        out_path = await download_sound(url)
+    except DownloadError as e:
+        return await inter.followup.send(str(e))
+    except Exception as e:
+        log_error("sound_download", e)
         return await inter.followup.send("Failed to fetch or save from URL.")
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["sound_path"] = str(out_path)
-    cfg.setdefault("sound", True)
-    save_smoke()
+    reminder_sounds.prewarm(str(out_path))
+    cfg = get_smoke_cfg(inter.guild_id)
+    old_path, cfg.sound_path = cfg.sound_path, str(out_path)
+    if old_path != cfg.sound_path:
+        await release_sound(old_path, inter.guild_id)
+    smoke_changed(inter.guild_id)
     return await inter.followup.send("🔊 Custom sound set from URL.")
 
 @smoke.command(name="soundreset", description="Revert to the default beep sound.")
 async def smoke_soundreset(inter: discord.Interaction):
     await inter.response.defer(ephemeral=True)
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    # Remove file if present
-    p = cfg.get("sound_path")
-    if p and os.path.exists(p):
-        try:
-            os.remove(p)
-        except Exception:
-            pass
-    cfg["sound_path"] = None
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    # Remove file if present (and no other server shares it)
+    await release_sound(cfg.sound_path, inter.guild_id)
+    cfg.sound_path = None
+    smoke_changed(inter.guild_id)
     return await inter.followup.send("🔔 Reverted to default beep.")
 
 @smoke.command(name="set", description="Set daily smoke times for this server.")
@@ -490,20 +2520,17 @@ async def smoke_set(inter: discord.Interaction, times: str, tz: str | None = Non
     parsed = parse_timestrings(times)
     if not parsed:
         return await inter.followup.send("Give one or more times like `4:20` or `09:30`, comma-separated.")
-    tzname = tz or smoke_cfg.get(inter.guild_id, {}).get("tz") or DEFAULT_TZ
+    cfg = get_smoke_cfg(inter.guild_id)
+    tzname = tz or cfg.tz or DEFAULT_TZ
     ch = channel or inter.channel
-    smoke_cfg[inter.guild_id] = {
-        "channel_id": ch.id,
-        "times": parsed,
-        "tz": tzname,
-        "message": message or smoke_cfg.get(inter.guild_id, {}).get("message") or "🚬 Time to smoke!",
-        "last_fired": smoke_cfg.get(inter.guild_id, {}).get("last_fired", {}),
-        "interval_minutes": None,
-        "interval_last_ts": None,
-        "sound": smoke_cfg.get(inter.guild_id, {}).get("sound", True),
-        "sound_path": smoke_cfg.get(inter.guild_id, {}).get("sound_path", None),
-    }
-    save_smoke()
+    cfg.channel_id = ch.id
+    cfg.times = parsed
+    cfg.tz = tzname
+    if message:
+        cfg.message = message
+    cfg.interval_minutes = None
+    cfg.interval_last_ts = None
+    smoke_changed(inter.guild_id)
     await inter.followup.send(f"✅ Daily reminders set for {', '.join(parsed)} ({tzname}) in {ch.mention}.")
 
 @smoke.command(name="message", description="Set a custom reminder message.")
@@ -512,12 +2539,11 @@ async def smoke_message(inter: discord.Interaction, message: str):
     await inter.response.defer(ephemeral=True)
     if not inter.guild:
         return await inter.followup.send("Server-only command.")
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["message"] = message
-    cfg.setdefault("times", [])
-    cfg.setdefault("channel_id", inter.channel.id)
-    cfg.setdefault("tz", DEFAULT_TZ)
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    cfg.message = message
+    if cfg.channel_id is None:
+        cfg.channel_id = inter.channel.id
+    smoke_changed(inter.guild_id)
     await inter.followup.send(f"📝 Message set to: {message}")
 
 @smoke.command(name="tz", description="Set the timezone for smoke reminders.")
@@ -526,37 +2552,36 @@ async def smoke_tz(inter: discord.Interaction, tz: str):
     await inter.response.defer(ephemeral=True)
     if not inter.guild:
         return await inter.followup.send("Server-only command.")
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["tz"] = tz
-    cfg.setdefault("times", [])
-    cfg.setdefault("channel_id", inter.channel.id)
-    cfg.setdefault("message", "🚬 Time to smoke!")
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    cfg.tz = tz
+    if cfg.channel_id is None:
+        cfg.channel_id = inter.channel.id
+    smoke_changed(inter.guild_id)
     await inter.followup.send(f"⏰ Timezone set to {tz}.")
 
 @smoke.command(name="list", description="Show current smoke reminder settings.")
 async def smoke_list(inter: discord.Interaction):
     cfg = smoke_cfg.get(inter.guild_id)
-    if not cfg or (not cfg.get("times") and not cfg.get("interval_minutes")):
+    if not cfg or (not cfg.times and not cfg.interval_minutes):
         return await inter.response.send_message("No smoke reminders set.", ephemeral=True)
-    ch_id = cfg.get("channel_id")
+    ch_id = cfg.channel_id
     guild = inter.guild
     ch = guild.get_channel(ch_id) if guild and ch_id else None
     channel_name = ch.mention if ch else (f"<#{ch_id}>" if ch_id else "(not set)")
-    mode = f"interval {cfg.get('interval_minutes')} min (voice-gated)" if cfg.get("interval_minutes") else f"times: {', '.join(cfg.get('times', []))}"
+    mode = f"interval {cfg.interval_minutes} min (voice-gated)" if cfg.interval_minutes else f"times: {', '.join(cfg.times)}"
     await inter.response.send_message(
-        f"Mode: {mode}\nTZ: {cfg.get('tz', DEFAULT_TZ)}\nChannel: {channel_name}\nMessage: {cfg.get('message', '🚬 Time to smoke!')}\nSound: {'on' if cfg.get('sound', True) else 'off'}" ,
+        f"Mode: {mode}\nTZ: {cfg.tz}\nChannel: {channel_name}\nMessage: {cfg.message}\nSound: {'on' if cfg.sound else 'off'}" ,
         ephemeral=True
     )
 
 @smoke.command(name="off", description="Turn off smoke reminders for this server (both modes).")
 async def smoke_off(inter: discord.Interaction):
     await inter.response.defer(ephemeral=True)
-    cfg = smoke_cfg.setdefault(inter.guild_id, {})
-    cfg["times"] = []
-    cfg["interval_minutes"] = None
-    cfg["interval_last_ts"] = None
-    save_smoke()
+    cfg = get_smoke_cfg(inter.guild_id)
+    cfg.times = []
+    cfg.interval_minutes = None
+    cfg.interval_last_ts = None
+    smoke_changed(inter.guild_id)
     await inter.followup.send("🛑 Smoke reminders turned off.")
 
 @smoke.command(name="test", description="Send a test smoke reminder now.")
@@ -576,144 +2601,6 @@ except Exception:
     pass
 
 # ===== Music commands =====
-@dataclass
-class Track:
-    title: str
-    url: str  # direct audio URL for FFmpeg
-    webpage_url: Optional[str] = None
-    requested_by: Optional[str] = None
-
-class GuildPlayer:
-    def __init__(self, guild_id: int):
-        self.guild_id = guild_id
-        self.queue: asyncio.Queue[Track] = asyncio.Queue()
-        self.play_task: Optional[asyncio.Task] = None
-        self.voice: Optional[discord.VoiceClient] = None
-        self.current: Optional[Track] = None
-        self.stop_signal = asyncio.Event()
-
-    async def ensure_player_task(self, guild: discord.Guild):
-        if self.play_task is None or self.play_task.done():
-            self.play_task = asyncio.create_task(self.player_loop(guild))
-
-    async def player_loop(self, guild: discord.Guild):
-        while not self.stop_signal.is_set():
-            self.current = await self.queue.get()
-            if self.voice is None or not self.voice.is_connected():
-                self.current = None
-                continue
-            source = discord.FFmpegPCMAudio(self.current.url, **FFMPEG_OPTS)
-            def after_play(err):
-                guild._state.loop.call_soon_threadsafe(self.queue.task_done)
-            self.voice.play(source, after=after_play)
-            while self.voice.is_playing() or self.voice.is_paused():
-                await asyncio.sleep(0.5)
-            self.current = None
-
-    def skip(self):
-        if self.voice and self.voice.is_playing():
-            self.voice.stop()
-
-    def stop(self):
-        self.stop_signal.set()
-        if self.voice and self.voice.is_connected():
-            try:
-                asyncio.create_task(self.voice.disconnect(force=True))
-            except Exception:
-                pass
-
-players: dict[int, GuildPlayer] = {}
-
-def get_player(guild: discord.Guild) -> GuildPlayer:
-    gp = players.get(guild.id)
-    if not gp:
-        gp = GuildPlayer(guild.id)
-        players[guild.id] = gp
-    return gp
-
-def make_spotify_client() -> Optional[Spotify]:
-    if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
-        auth = SpotifyClientCredentials(
-            client_id=SPOTIFY_CLIENT_ID,
-            client_secret=SPOTIFY_CLIENT_SECRET
-        )
-        return Spotify(client_credentials_manager=auth)
-    return None
-
-sp_client = make_spotify_client()
-
-async def youtube_search_first(query: str) -> Optional[Track]:
-    with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-            if info is None:
-                return None
-            if "entries" in info and info["entries"]:
-                info = info["entries"][0]
-            stream_url = info.get("url") or info.get("webpage_url")
-            if not stream_url:
-                return None
-            title = info.get("title") or query
-            return Track(title=title, url=stream_url, webpage_url=info.get("webpage_url"))
-        except Exception:
-            return None
-
-def parse_spotify(url: str) -> List[str]:
-    if not sp_client:
-        return []
-    try:
-        if "/track/" in url:
-            tid = url.split("/track/")[1].split("?")[0]
-            t = sp_client.track(tid)
-            artists = ", ".join(a["name"] for a in t["artists"])
-            return [f"{artists} - {t['name']} audio"]
-        if "/album/" in url:
-            aid = url.split("/album/")[1].split("?")[0]
-            album = sp_client.album(aid)
-            out = []
-            for t in album["tracks"]["items"]:
-                artists = ", ".join(a["name"] for a in t["artists"])
-                out.append(f"{artists} - {t['name']} audio")
-            return out
-        if "/playlist/" in url:
-            pid = url.split("/playlist/")[1].split("?")[0]
-            pl = sp_client.playlist(pid)
-            out = []
-            for it in pl["tracks"]["items"]:
-                t = it["track"]
-                if not t:
-                    continue
-                artists = ", ".join(a["name"] for a in t["artists"])
-                out.append(f"{artists} - {t['name']} audio")
-            return out
-    except Exception:
-        return []
-    return []
-
-async def enqueue_from_input(guild: discord.Guild, query: str, requested_by: str) -> int:
-    gp = get_player(guild)
-    if not SPOTIFY_URL_RE.search(query):
-        q = query if query.startswith("http") else f"ytsearch1:{query}"
-        track = await youtube_search_first(q)
-        if track:
-            track.requested_by = requested_by
-            await gp.queue.put(track)
-            return 1
-        return 0
-
-    queries = parse_spotify(query)
-    if not queries:
-        queries = [query]
-
-    added = 0
-    for q in queries:
-        tr = await youtube_search_first(f"ytsearch1:{q}")
-        if tr:
-            tr.requested_by = requested_by
-            await gp.queue.put(tr)
-            added += 1
-    return added
-
 @tree.command(name="join", description="Have Dooberhut Bot join your current voice channel.")
 async def join(inter: discord.Interaction):
     if not inter.user or not isinstance(inter.user, discord.Member):
@@ -745,31 +2632,112 @@ async def play(inter: discord.Interaction, query: str):
             await gp.ensure_player_task(inter.guild)
         else:
             return await inter.followup.send("Dooberhut Bot isn't in a voice channel. Use `/join` first.")
-    added = await enqueue_from_input(inter.guild, query, requested_by=inter.user.display_name)
+    if gp.queue.full():
+        return await inter.followup.send(f"The queue is full ({QUEUE_MAX_TRACKS} tracks). Use `/remove` or `/stop` first.")
+
+    progress_msg = None
+    last_edit = 0.0
+
+    async def on_progress(done: int, total: int, added: int):
+        nonlocal progress_msg, last_edit
+        if total <= 1 or not added or done == total:
+            return
+        text = f"Queued **{added}** of {total} track(s) so far… ({done}/{total} looked up)"
+        now = time.monotonic()
+        try:
+            if progress_msg is None:
+                progress_msg = await inter.followup.send(text, wait=True)
+                last_edit = now
+            elif now - last_edit >= PROGRESS_EDIT_INTERVAL:
+                last_edit = now
+                await progress_msg.edit(content=text)
+        except discord.HTTPException:
+            pass
+
+    added = await enqueue_from_input(inter.guild, query, requested_by=inter.user.display_name, on_progress=on_progress)
     if added == 0:
         return await inter.followup.send("Couldn't find anything to play.")
     await gp.ensure_player_task(inter.guild)
-    await inter.followup.send(f"Queued **{added}** track(s). Use `/queue` to view.")
+    text = f"Queued **{added}** track(s). Use `/queue` to view."
+    if progress_msg is not None:
+        try:
+            return await progress_msg.edit(content=text)
+        except discord.HTTPException:
+            pass
+    await inter.followup.send(text)
+
+@play.autocomplete("query")
+async def play_autocomplete(inter: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    if not inter.guild_id or current.startswith("http"):
+        return []
+    # picking one sends its page URL, which youtube_search_first maps back to the cached video
+    return [app_commands.Choice(name=title[:100], value=webpage_url)
+            for _, title, webpage_url in track_index.search(current, inter.guild_id)]
 
 @tree.command(name="queue", description="Show upcoming songs.")
-async def queue_cmd(inter: discord.Interaction):
+@app_commands.describe(page="Page number (10 tracks per page)")
+async def queue_cmd(inter: discord.Interaction, page: app_commands.Range[int, 1] = 1):
     if not inter.guild:
         return await inter.response.send_message("Server-only command.")
     gp = get_player(inter.guild)
-    items = list(gp.queue._queue)
+    total = len(gp.queue)
+    pages = max(1, -(-total // QUEUE_PAGE_SIZE))
+    page = min(page, pages)
+    start = (page - 1) * QUEUE_PAGE_SIZE
     lines = []
     if gp.current:
         lines.append(f"**Now:** {gp.current.title} *(requested by {gp.current.requested_by})*")
-    if not items:
+    if not total:
         if not lines:
             return await inter.response.send_message("Queue is empty.")
     else:
-        for i, t in enumerate(items[:10], start=1):
+        for i, t in enumerate(gp.queue.slice(start, start + QUEUE_PAGE_SIZE), start=start + 1):
             lines.append(f"{i}. {t.title} *(requested by {t.requested_by})*")
-        if len(items) > 10:
-            lines.append(f"...and {len(items) - 10} more")
+        lines.append(f"Page {page}/{pages} · {total} track(s) queued")
     await inter.response.send_message("\n".join(lines))
 
+@tree.command(name="remove", description="Remove a song from the queue.")
+@app_commands.describe(position="Position in /queue")
+async def remove_cmd(inter: discord.Interaction, position: app_commands.Range[int, 1]):
+    if not inter.guild:
+        return await inter.response.send_message("Server-only command.")
+    gp = get_player(inter.guild)
+    if position > len(gp.queue):
+        return await inter.response.send_message(f"There are only {len(gp.queue)} track(s) queued.", ephemeral=True)
+    track = gp.queue.remove(position - 1)
+    gp.kick_prefetch()
+    await inter.response.send_message(f"🗑️ Removed **{track.title}**.")
+
+@tree.command(name="move", description="Move a queued song to another position.")
+@app_commands.describe(from_position="Current position in /queue", to_position="New position")
+async def move_cmd(inter: discord.Interaction, from_position: app_commands.Range[int, 1], to_position: app_commands.Range[int, 1]):
+    if not inter.guild:
+        return await inter.response.send_message("Server-only command.")
+    gp = get_player(inter.guild)
+    if from_position > len(gp.queue):
+        return await inter.response.send_message(f"There are only {len(gp.queue)} track(s) queued.", ephemeral=True)
+    track = gp.queue.move(from_position - 1, to_position - 1)
+    gp.kick_prefetch()
+    await inter.response.send_message(f"↕️ Moved **{track.title}** to position {min(to_position, len(gp.queue))}.")
+
+@tree.command(name="shuffle", description="Shuffle the queue.")
+async def shuffle_cmd(inter: discord.Interaction):
+    if not inter.guild:
+        return await inter.response.send_message("Server-only command.")
+    gp = get_player(inter.guild)
+    gp.queue.shuffle()
+    gp.kick_prefetch()
+    await inter.response.send_message(f"🔀 Shuffled {len(gp.queue)} track(s).")
+
+@tree.command(name="dedupe", description="Remove duplicate songs from the queue.")
+async def dedupe_cmd(inter: discord.Interaction):
+    if not inter.guild:
+        return await inter.response.send_message("Server-only command.")
+    gp = get_player(inter.guild)
+    removed = gp.queue.dedupe()
+    gp.kick_prefetch()
+    await inter.response.send_message(f"🧹 Removed {removed} duplicate(s).")
+
 @tree.command(name="skip", description="Skip the current song.")
 async def skip_cmd(inter: discord.Interaction):
     if not inter.guild:
@@ -783,12 +2751,8 @@ async def stop_cmd(inter: discord.Interaction):
     if not inter.guild:
         return await inter.response.send_message("Server-only command.")
     gp = get_player(inter.guild)
-    while not gp.queue.empty():
-        try:
-            gp.queue.get_nowait()
-            gp.queue.task_done()
-        except Exception:
-            break
+    gp.queue.clear()
+    gp._drop_warm()
     gp.skip()
     await inter.response.send_message("⏹️ Stopped and cleared queue.")
 
@@ -800,17 +2764,314 @@ async def leave_cmd(inter: discord.Interaction):
     gp.stop()
     await inter.response.send_message("👋 Dooberhut Bot left the voice channel.")
 
-@bot.event
-async def on_ready():
+def _fmt_ms(v: Optional[float]) -> str:
+    return "-" if v is None else f"{v * 1000:.0f}ms"
+
+@tree.command(name="botstats", description="Show Dooberhut Bot internals (admins).")
+@app_commands.default_permissions(administrator=True)
+async def botstats_cmd(inter: discord.Interaction):
+    rs = resolver.stats()
+    ps = player_stats()
+    lookups = track_cache.hits + track_cache.misses
+    lines = [
+        f"**Players**: {ps['players']} live, {ps['connected']} in voice, {ps['playing']} playing, "
+        f"{ps['queued']} queued track(s), {ps['tasks']} asyncio task(s)",
+        f"**Resolver** ({rs['mode']} x{rs['workers']}): queued {rs['queue_depth']} across {rs['guilds_waiting']} guild(s), "
+        f"in flight {rs['in_flight']}, failures {rs['failures']}",
+        f"wait p50 {_fmt_ms(rs['wait']['p50'])} / p95 {_fmt_ms(rs['wait']['p95'])} · "
+        f"run p50 {_fmt_ms(rs['run']['p50'])} / p95 {_fmt_ms(rs['run']['p95'])}",
+        f"**Track cache**: {len(track_cache.queries)} queries, {len(track_cache.streams)} streams, "
+        f"hit rate {track_cache.hits}/{lookups}" + (f", {track_cache.shared_hits} from shared db" if TRACK_CACHE_DB else ""),
+        f"**Track gaps**: p50 {_fmt_ms(track_gaps.percentile(50))} / p95 {_fmt_ms(track_gaps.percentile(95))} "
+        f"over {track_gaps.count} transition(s)",
+        f"**Reminders**: {len(smoke_sched)} scheduled, {reminder_dispatch.backlog} waiting to send, "
+        f"{reminder_dispatch.delivered} delivered, lateness p50 {_fmt_ms(reminder_dispatch.lateness.percentile(50))} / "
+        f"p95 {_fmt_ms(reminder_dispatch.lateness.percentile(95))}, "
+        f"{reminder_dispatch.rate_limited} rate-limited, {reminder_dispatch.failures} failed",
+        f"**Config saves**: p95 {_fmt_ms(smoke_store.save_time.percentile(95))} over {smoke_store.save_time.count} flush(es), "
+        f"{smoke_store.failures} failed",
+        f"**Event loop**: lag p50 {_fmt_ms(loop_lag.percentile(50))} / p95 {_fmt_ms(loop_lag.percentile(95))} / "
+        f"max {_fmt_ms(loop_lag.snapshot()['max'])}",
+        f"**Queue snapshots**: p95 {_fmt_ms(player_store.save_time.percentile(95))} over "
+        f"{player_store.save_time.count} save(s), {player_store.failures} failed",
+    ]
+    if audio_cache.dir is not None:
+        lines.append(f"**Audio cache**: {len(audio_cache.files)} file(s), {audio_cache.bytes / 2**20:.0f}/"
+                     f"{audio_cache.max_bytes / 2**20:.0f} MiB, {audio_cache.hits} local play(s), "
+                     f"{audio_cache.stored} stored, {len(audio_cache._jobs)} downloading, {audio_cache.failures} failed")
+    if sp_client is not None:
+        ss = sp_client.stats()
+        lines.append(f"**Spotify**: {ss['requests']} request(s), {ss['cache_hits']} served from cache, "
+                     f"{ss['revalidated']} revalidated (304), {ss['cached']} cached response(s)")
+    hs = http.stats()
+    lines.append(f"**HTTP pool**: {hs['in_use']}/{hs['limit']} in use")
+    for host, st in sorted(hs["hosts"].items(), key=lambda kv: -kv[1]["requests"])[:5]:
+        lines.append(f"· {host}: {st['requests']} req, {st['errors']} err, p50 {_fmt_ms(st['p50'])} / p95 {_fmt_ms(st['p95'])}")
+    await inter.response.send_message("\n".join(lines), ephemeral=True)
+
+# ===== Metrics =====
+loop_lag = LatencyStats()  # how late the loop wakes a LOOP_LAG_INTERVAL sleep
+
+async def watch_loop_lag():
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL))
+
+metrics.histogram("dooberhut_resolve_seconds", resolver.run_time, "Time spent inside yt-dlp per lookup")
+metrics.histogram("dooberhut_resolve_wait_seconds", resolver.wait_time, "Time a lookup waited for a resolver worker")
+metrics.histogram("dooberhut_ffmpeg_start_seconds", ffmpeg_start, "Time to start an FFmpeg audio source")
+metrics.histogram("dooberhut_track_gap_seconds", track_gaps, "Silence between consecutive queued tracks")
+metrics.histogram("dooberhut_reminder_lateness_seconds", reminder_dispatch.lateness, "Reminder delivery time minus due time")
+metrics.histogram("dooberhut_save_seconds", smoke_store.save_time, "Duration of SQLite saves", store="smoke")
+metrics.histogram("dooberhut_save_seconds", player_store.save_time, "Duration of SQLite saves", store="players")
+metrics.histogram("dooberhut_loop_lag_seconds", loop_lag, "Event-loop wakeup lag")
+metrics.gauge("dooberhut_track_cache_lookups_total", "Track cache lookups by result", lambda: {
+    (("result", "hit"),): track_cache.hits, (("result", "miss"),): track_cache.misses,
+    (("result", "shared_hit"),): track_cache.shared_hits,
+}, kind="counter")
+metrics.gauge("dooberhut_spotify_lookups_total", "Spotify API lookups by result", lambda: {
+    (("result", result),): sp_client.stats()[key] if sp_client else 0
+    for result, key in (("request", "requests"), ("cache_hit", "cache_hits"), ("revalidated", "revalidated"))
+}, kind="counter")
+metrics.gauge("dooberhut_resolve_failures_total", "yt-dlp lookups that raised", lambda: resolver.failures, kind="counter")
+metrics.gauge("dooberhut_rate_limited_total", "HTTP 429 responses", lambda: {
+    (("api", "discord_reminders"),): reminder_dispatch.rate_limited,
+    (("api", "spotify"),): sp_client.rate_limited if sp_client else 0,
+}, kind="counter")
+metrics.gauge("dooberhut_reminders_total", "Reminder deliveries by result", lambda: {
+    (("result", "delivered"),): reminder_dispatch.delivered, (("result", "failed"),): reminder_dispatch.failures,
+}, kind="counter")
+metrics.gauge("dooberhut_http_requests_total", "Requests through the shared HTTP pool", lambda: {
+    (("host", host), ("result", result)): st[key]
+    for host, st in http.hosts.items() for result, key in (("ok", "requests"), ("error", "errors"))
+}, kind="counter")
+metrics.gauge("dooberhut_http_pool_connections", "Shared HTTP pool requests in flight and its connection limit", lambda: {
+    (("state", "in_use"),): sum(st["in_flight"] for st in http.hosts.values()), (("state", "limit"),): http.limit,
+})
+metrics.gauge("dooberhut_http_in_flight", "Requests in flight per host", lambda: {
+    (("host", host),): st["in_flight"] for host, st in http.hosts.items()
+})
+metrics.gauge("dooberhut_audio_cache_bytes", "Bytes in the local audio cache", lambda: audio_cache.bytes)
+metrics.gauge("dooberhut_audio_cache_plays_total", "Track plays by audio source", lambda: {
+    (("source", "local"),): audio_cache.hits, (("source", "stream"),): audio_cache.streamed,
+}, kind="counter")
+metrics.gauge("dooberhut_voice_clients", "Connected voice clients", lambda: len(bot.voice_clients))
+metrics.gauge("dooberhut_players", "Live guild players", lambda: len(players))
+metrics.gauge("dooberhut_queued_tracks", "Tracks waiting in guild queues", lambda: sum(len(gp.queue) for gp in players.values()))
+metrics.gauge("dooberhut_queue_depth_max", "Longest guild queue", lambda: max((len(gp.queue) for gp in players.values()), default=0))
+metrics.gauge("dooberhut_resolver_queue_depth", "Lookups waiting for a resolver worker", lambda: resolver.stats()["queue_depth"])
+metrics.gauge("dooberhut_reminders_scheduled", "Guilds with a pending reminder", lambda: len(smoke_sched))
+metrics.gauge("dooberhut_reminder_backlog", "Reminders waiting to be sent", lambda: reminder_dispatch.backlog)
+metrics.gauge("dooberhut_loop_lag_last_seconds", "Most recent event-loop lag probe", lambda: loop_lag.samples[-1] if loop_lag.samples else 0)
+metrics.gauge("dooberhut_asyncio_tasks", "Live asyncio tasks", lambda: len(asyncio.all_tasks()))
+
+class LoopWatchdog:
+    """Thread that pings the event loop and records what it was doing when it stalls.
+
+    Several times per threshold the thread schedules a callback on the loop; if it hasn't run
+    within LOOP_STALL_MS, the loop thread's current stack is captured (the blocking call
+    is on it) and, once the loop recovers, the stall is charged to that call site.
+    """
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.stall_time = LatencyStats()
+        self.sites: dict[tuple[str, str], dict] = {}
+        self._pong = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        if self._thread is not None or self.threshold <= 0:
+            return
+        self._thread = threading.Thread(
+            target=self._run, args=(loop, threading.get_ident()), name="loop-watchdog", daemon=True,
+        )
+        self._thread.start()
+
+    def _run(self, loop: asyncio.AbstractEventLoop, loop_thread: int):
+        while not loop.is_closed():
+            self._pong.clear()
+            sent = time.monotonic()
+            try:
+                loop.call_soon_threadsafe(self._pong.set)
+            except RuntimeError:
+                return  # loop closed
+            if not self._pong.wait(self.threshold):
+                frame = sys._current_frames().get(loop_thread)
+                stack = traceback.extract_stack(frame) if frame is not None else []
+                del frame
+                while not self._pong.wait(1.0):
+                    if loop.is_closed():
+                        return
+                self._record(stack, time.monotonic() - sent)
+            time.sleep(self.threshold / 2)  # any stall of 1.5x the threshold is caught
+
+    def _record(self, stack: list, duration: float):
+        own = [f for f in stack if f.filename == __file__]
+        where = f"{os.path.basename(own[-1].filename)}:{own[-1].lineno} in {own[-1].name}" if own else "?"
+        leaf = f"{os.path.basename(stack[-1].filename)}:{stack[-1].lineno} in {stack[-1].name}" if stack else "?"
+        site = self.sites.get((where, leaf))
+        if site is None:
+            if len(self.sites) >= LOOP_STALL_SITES:  # forget the least costly site
+                del self.sites[min(self.sites, key=lambda k: self.sites[k]["total"])]
+            site = self.sites[(where, leaf)] = {"count": 0, "total": 0.0, "max": 0.0, "last": 0.0, "stack": ""}
+        site["count"] += 1
+        site["total"] += duration
+        site["max"] = max(site["max"], duration)
+        site["last"] = time.time()
+        site["stack"] = "".join(traceback.format_list(stack[-8:]))
+        self.stall_time.observe(duration)  # LatencyStats isn't locked, but only this thread writes it
+        print(f"Event loop blocked {duration * 1000:.0f}ms at {where} ({leaf})")
+
+    def top(self, n: int) -> list[tuple[tuple[str, str], dict]]:
+        return sorted(self.sites.items(), key=lambda kv: -kv[1]["total"])[:n]
+
+    def reset(self):
+        self.sites.clear()
+
+watchdog = LoopWatchdog(LOOP_STALL_MS / 1000)
+metrics.histogram("dooberhut_loop_stall_seconds", watchdog.stall_time, "Event-loop stalls caught by the watchdog")
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = METRICS_PORT + SHARD_GROUP  # one port per shard process
     try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+    except OSError as e:
+        log_error("metrics_server", e)
+        return
+    print(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+_background: set[asyncio.Task] = set()
+
+debug = app_commands.Group(
+    name="debug", description="Dooberhut Bot diagnostics (admins)",
+    default_permissions=discord.Permissions(administrator=True),
+)
+
+@debug.command(name="stalls", description="Show the code that blocked the event loop the most.")
+@app_commands.describe(top="How many call sites to show", reset="Clear the report after showing it")
+async def debug_stalls(inter: discord.Interaction, top: app_commands.Range[int, 1, 10] = 5, reset: bool = False):
+    if LOOP_STALL_MS <= 0:
+        return await inter.response.send_message("The stall watchdog is off (`LOOP_STALL_MS=0`).", ephemeral=True)
+    sites = watchdog.top(top)
+    if not sites:
+        return await inter.response.send_message(f"No stalls over {LOOP_STALL_MS}ms so far. 🎉", ephemeral=True)
+    lines = [f"**Loop stalls over {LOOP_STALL_MS}ms** ({watchdog.stall_time.count} total, "
+             f"p95 {_fmt_ms(watchdog.stall_time.percentile(95))})"]
+    for (where, leaf), st in sites:
+        lines.append(f"**{where}** → `{leaf}`: {st['count']}x, {st['total']:.1f}s total, max {_fmt_ms(st['max'])}, "
+                     f"last <t:{int(st['last'])}:R>")
+    body = "\n".join(lines)
+    stack = sites[0][1]["stack"]
+    if len(body) + len(stack) < 1900:
+        body += f"\nWorst site's stack:\n```\n{stack}```"
+    if reset:
+        watchdog.reset()
+    await inter.response.send_message(body[:2000], ephemeral=True)
+
+tree.add_command(debug)
+
+def command_tree_hash() -> str:
+    """Digest of every command's registration payload, as tree.sync() would upload it."""
+    payload = sorted((cmd.to_dict(tree) for cmd in tree.get_commands()), key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def sync_commands_if_changed():
+    """Global tree.sync() only when the commands differ from the last successful sync.
+
+    The digest is kept in SMOKE_DB per application, so restarts and gateway reconnects
+    don't re-upload an unchanged tree. FORCE_COMMAND_SYNC=1 syncs regardless.
+    """
+    key = f"command_hash:{bot.application_id}"
+    digest = command_tree_hash()
+    try:
+        if not FORCE_COMMAND_SYNC and await smoke_store.get_meta(key) == digest:
+            print("Slash commands unchanged; skipping sync")
+            return
         await tree.sync()
+        await smoke_store.set_meta(key, digest)
+        print("Slash commands synced")
     except Exception as e:
-        print("Slash sync failed:", e)
+        log_error("command_sync", e)
+
+@bot.event
+async def setup_hook():
+    http.session()
+    _background.add(asyncio.create_task(watch_loop_lag()))
+    watchdog.start(asyncio.get_running_loop())
+    if SHARD_GROUP == 0:  # commands are global; one process syncing them is enough
+        _background.add(asyncio.create_task(sync_commands_if_changed()))  # runs alongside the gateway connect
+    if METRICS_PORT:
+        await start_metrics_server()
+    try:  # container stops and redeploys send SIGTERM; discord.py only handles Ctrl+C
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: _background.add(asyncio.create_task(bot.close()))
+        )
+    except NotImplementedError:  # Windows
+        pass
+
+_client_close = bot.close
+_final_save: Optional[asyncio.Task] = None
+
+async def _save_before_close():
+    # voice is still connected here; discord.py's close stops every player, which would
+    # wake player_loop and drain or drop what's queued before a later snapshot saw it
+    if snapshot_players.is_running():
+        snapshot_players.cancel()
+    if PLAYER_SNAPSHOT_INTERVAL > 0:
+        await player_store.save()
+    await smoke_store.flush()
+
+async def close():
+    """Final player snapshot and config flush, then discord.py's close and the shared HTTP session."""
+    global shutting_down, _final_save
+    if _final_save is None:
+        shutting_down = True
+        _final_save = asyncio.create_task(_save_before_close())
+    try:
+        await _final_save
+        await _client_close()
+    finally:
+        await http.close()
+
+bot.close = close
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    # interval reminders are voice-gated, so the bot joining/leaving changes their schedule
+    if bot.user and member.id == bot.user.id and before.channel != after.channel:
+        smoke_sched.reschedule(member.guild.id)
+    if before.channel != after.channel:
+        gp = players.get(member.guild.id)
+        if gp is not None:
+            gp.watch_channel()
+
+@bot.event
+async def on_ready():
     await bot.change_presence(activity=discord.Game(name="music in Dooberhut 🎶"))
-    smoke_tick.start()
-    print(f"✅ Dooberhut Bot is online as {bot.user} (ID: {bot.user.id})")
+    smoke_sched.start()
+    if not reap_players.is_running():
+        reap_players.start()
+    if os.path.exists(REMINDER_BEEP):
+        reminder_sounds.prewarm(REMINDER_BEEP)
+    if TRACK_CACHE_PATH and not track_cache_flush.is_running():
+        track_cache_flush.start()
+    if PLAYER_SNAPSHOT_INTERVAL > 0 and not snapshot_players.is_running():
+        snapshot_players.start()  # restores saved queues once, then snapshots periodically
+    shards = f", shards {sorted(bot.shards)} of {bot.shard_count}" if SHARD_COUNT else ""
+    print(f"✅ Dooberhut Bot is online as {bot.user} (ID: {bot.user.id}){shards}")
 
 if __name__ == "__main__":
     if not DISCORD_TOKEN:
         raise SystemExit("Set DISCORD_TOKEN in your environment or .env file.")
-    bot.run(DISCORD_TOKEN)
+    try:
+        bot.run(DISCORD_TOKEN)  # close() saves players and settings on the way out
+    finally:
+        smoke_store.flush_sync()  # anything changed after close()'s flush
@@ -0,0 +1,131 @@
+"""Run Dooberhut Bot as several processes, each owning a group of shards.
+
+Every child is a normal `python bot.py` with SHARD_COUNT / SHARD_IDS / SHARD_GROUP set,
+so each one runs its own event loop (and its own yt-dlp workers) on its own core.
+Reminder settings, queue snapshots and the track cache are shared through SQLite on the
+same volume (SMOKE_DB, TRACK_CACHE_DB).
+
+    SHARD_COUNT=8 SHARD_PROCESSES=4 python launcher.py
+
+SHARD_COUNT defaults to Discord's recommendation; SHARD_PROCESSES to the CPU count.
+Children that exit are restarted with backoff; SIGTERM/SIGINT stop them all.
+"""
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+IDENTIFY_INTERVAL = 5.5  # Discord allows max_concurrency IDENTIFYs per 5 seconds
+RESTART_BACKOFF_MAX = 60
+
+
+def recommended_shards(token: str) -> tuple[int, int]:
+    """(shard count, max_concurrency) from Discord's /gateway/bot."""
+    req = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (dooberhut, 1.0)"},
+    )
+    with urllib.request.urlopen(req, timeout=15) as resp:
+        data = json.load(resp)
+    return int(data["shards"]), int(data.get("session_start_limit", {}).get("max_concurrency", 1))
+
+
+def shard_groups(count: int, processes: int) -> list[list[int]]:
+    """Split shards 0..count-1 into `processes` contiguous groups of near-equal size."""
+    processes = max(1, min(processes, count))
+    size, extra = divmod(count, processes)
+    groups, start = [], 0
+    for i in range(processes):
+        n = size + (1 if i < extra else 0)
+        groups.append(list(range(start, start + n)))
+        start += n
+    return groups
+
+
+class Child:
+    def __init__(self, group: int, shards: list[int], count: int, start_at: float):
+        self.group = group
+        self.shards = shards
+        self.count = count
+        self.start_at = start_at  # staggered so the groups don't all IDENTIFY at once
+        self.proc: subprocess.Popen | None = None
+        self.backoff = 1.0
+        self.started = 0.0
+
+    def spawn(self):
+        env = dict(os.environ, SHARD_COUNT=str(self.count), SHARD_GROUP=str(self.group),
+                   SHARD_IDS=",".join(map(str, self.shards)))
+        self.proc = subprocess.Popen([sys.executable, BOT_PATH], env=env)
+        self.started = time.monotonic()
+        print(f"[launcher] group {self.group} (shards {self.shards[0]}-{self.shards[-1]}) started, pid {self.proc.pid}")
+
+    def poll(self, now: float):
+        if self.proc is None:
+            if now >= self.start_at:
+                self.spawn()
+            return
+        code = self.proc.poll()
+        if code is None:
+            return
+        if now - self.started > RESTART_BACKOFF_MAX:
+            self.backoff = 1.0  # it ran fine for a while; this is a fresh failure
+        print(f"[launcher] group {self.group} exited with {code}; restarting in {self.backoff:.0f}s")
+        self.proc = None
+        self.start_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+
+
+def main():
+    token = os.getenv("DISCORD_TOKEN")
+    if not token:
+        raise SystemExit("Set DISCORD_TOKEN in your environment or .env file.")
+    count_env = os.getenv("SHARD_COUNT", "auto").strip().lower()
+    concurrency = 1
+    if count_env in ("", "auto"):
+        count, concurrency = recommended_shards(token)
+    else:
+        count = int(count_env)
+    groups = shard_groups(count, int(os.getenv("SHARD_PROCESSES", str(os.cpu_count() or 1))))
+
+    now = time.monotonic()
+    children, delay = [], 0.0
+    for i, shards in enumerate(groups):
+        children.append(Child(i, shards, count, now + delay))
+        delay += IDENTIFY_INTERVAL * -(-len(shards) // concurrency)
+    print(f"[launcher] {count} shard(s) across {len(children)} process(es)")
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while not stopping:
+        now = time.monotonic()
+        for child in children:
+            child.poll(now)
+        time.sleep(1)
+
+    for child in children:
+        if child.proc and child.proc.poll() is None:
+            child.proc.send_signal(signal.SIGINT)  # bot.run exits cleanly, so queues and settings get saved
+    for child in children:
+        if child.proc:
+            try:
+                child.proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                child.proc.kill()
+
+
+if __name__ == "__main__":
+    main()